@@ -0,0 +1,256 @@
+# Copyright 2016-2021 Matthew Wall
+# Distributed under the terms of the GNU Public License (GPLv3)
+
+"""
+Benchmarks for the Influx uploader.
+
+Measure how fast records are encoded by get_post_body, for each line format,
+each obs_to_upload, and with and without unit conversion, then how fast an
+InfluxThread uploads records to a stub influx server running on localhost.
+The results are written as JSON, so that the results from one release can be
+compared with those from another.
+
+This requires python 3 and weewx.  Run it from the top of the source tree:
+
+PYTHONPATH=bin python bench/influx_bench.py --output=bench.json
+PYTHONPATH=bin python bench/influx_bench.py --compare=old.json
+"""
+
+import json
+import optparse
+import platform
+import queue
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import weewx
+import user.influx
+
+# a typical archive record from a davis vantage station
+RECORD = {
+    'dateTime': 1700000000, 'usUnits': weewx.US, 'interval': 5,
+    'barometer': 30.012, 'pressure': 29.321, 'altimeter': 30.008,
+    'inTemp': 71.3, 'outTemp': 45.6, 'inHumidity': 38.0, 'outHumidity': 81.0,
+    'windSpeed': 4.0, 'windDir': 225.0, 'windGust': 9.0, 'windGustDir': 247.5,
+    'rainRate': 0.0, 'rain': 0.0, 'dewpoint': 40.2, 'windchill': 44.1,
+    'heatindex': 45.6, 'ET': 0.001, 'radiation': 312.0, 'UV': 1.2,
+    'extraTemp1': 50.3, 'soilTemp1': 48.1, 'leafWet1': 0.0,
+    'rxCheckPercent': 99.1, 'txBatteryStatus': 0.0,
+    'consBatteryVoltage': 4.7, 'forecastRule': 45.0, 'appTemp': 43.9,
+    'cloudbase': 1523.4, 'humidex': 45.6, 'maxSolarRad': 420.6,
+}
+
+# the inputs used when obs_to_upload is none
+INPUTS = {
+    'outTemp': {'format': '%.1f'},
+    'outHumidity': {'format': '%.0f'},
+    'barometer': {'units': 'mbar', 'format': '%.1f'},
+    'windSpeed': {},
+    'windDir': {},
+    'rain': {},
+}
+
+LINE_FORMATS = ['single-line', 'multi-line', 'multi-line-dotted']
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Accept everything, like an influx server with nowhere to put it"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.reply(204)
+
+    def do_POST(self):
+        n = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(n)
+        self.server.posts += 1
+        self.server.nbytes += n
+        self.reply(204 if self.path.startswith('/write') else 200)
+
+    def reply(self, code):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.posts = 0
+        self.nbytes = 0
+        self.url = 'http://127.0.0.1:%d' % self.server_port
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+
+def make_records(count, start_ts=RECORD['dateTime']):
+    """Records that differ a little, one per minute"""
+    records = []
+    for i in range(count):
+        r = dict(RECORD)
+        r['dateTime'] = start_ts + 60 * i
+        r['outTemp'] += (i % 100) / 10.0
+        r['barometer'] += (i % 50) / 1000.0
+        records.append(r)
+    return records
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def bench_encoder(count):
+    """Time get_post_body for every combination of line format,
+    obs_to_upload, and unit system"""
+    results = []
+    records = make_records(count)
+    for line_format in LINE_FORMATS:
+        for obs_to_upload in ['most', 'all', 'none']:
+            for unit_system in [None, weewx.METRIC]:
+                t = user.influx.InfluxThread(
+                    queue.Queue(), 'bench', create_database=False,
+                    line_format=line_format, obs_to_upload=obs_to_upload,
+                    inputs=INPUTS if obs_to_upload == 'none' else dict(),
+                    unit_system=unit_system, augment_record=False,
+                    tags='station=A')
+                # the first record builds the templates
+                t.get_post_body(records[0], 'archive')
+                times = []
+                nbytes = 0
+                start = time.perf_counter()
+                for r in records:
+                    t0 = time.perf_counter()
+                    body, _ = t.get_post_body(r, 'archive')
+                    times.append(time.perf_counter() - t0)
+                    nbytes += len(body)
+                elapsed = time.perf_counter() - start
+                results.append({
+                    'name': 'encode',
+                    'line_format': line_format,
+                    'obs_to_upload': obs_to_upload,
+                    'conversion': unit_system is not None,
+                    'records': count,
+                    'records_per_second': count / elapsed,
+                    'p50_us': percentile(times, 50) * 1e6,
+                    'p99_us': percentile(times, 99) * 1e6,
+                    'bytes_per_record': nbytes / float(count),
+                })
+                print_result(results[-1])
+    return results
+
+
+def bench_upload(count):
+    """Time how long an InfluxThread takes to upload records that are all
+    waiting in the queue"""
+    results = []
+    configs = [
+        {'batch_size': 1},
+        {'batch_size': 1, 'keep_alive': False},
+        {'batch_size': 100},
+        {'batch_size': 100, 'compression': 'gzip'},
+        {'batch_size': 100, 'engine': 'asyncio'},
+    ]
+    for config in configs:
+        server = StubServer().start()
+        q = queue.Queue()
+        for r in make_records(count):
+            q.put(user.influx.QueuedRecord('archive', r))
+        q.put(None)
+        t = user.influx.InfluxThread(
+            q, 'bench', server_url=server.url, create_database=False,
+            augment_record=False, tags='station=A', log_success=False,
+            **config)
+        start = time.perf_counter()
+        t.start()
+        t.join()
+        elapsed = time.perf_counter() - start
+        server.shutdown()
+        server.server_close()
+        result = {
+            'name': 'upload',
+            'records': count,
+            'records_per_second': count / elapsed,
+            'posts': server.posts,
+            'bytes_per_record': server.nbytes / float(count),
+        }
+        result.update(config)
+        results.append(result)
+        print_result(result)
+    return results
+
+
+def print_result(result):
+    print(', '.join('%s=%s' % (k, ('%.1f' % v) if isinstance(v, float) else v)
+                    for (k, v) in result.items()))
+
+
+def result_key(result):
+    """Identify the same benchmark in another set of results"""
+    return tuple(sorted((k, v) for (k, v) in result.items()
+                        if isinstance(v, (str, bool)) or k == 'batch_size'))
+
+
+def compare(results, filename):
+    with open(filename) as f:
+        old = dict((result_key(r), r) for r in json.load(f)['results'])
+    for r in results:
+        o = old.get(result_key(r))
+        if o is None:
+            continue
+        change = 100.0 * (r['records_per_second'] /
+                          o['records_per_second'] - 1)
+        print("%+6.1f%% records/s  %s" % (
+            change, ' '.join('%s=%s' % kv for kv in result_key(r))))
+
+
+def main():
+    usage = """Usage: python bench/influx_bench.py [--records=N]
+                                   [--upload-records=N]
+                                   [--output=FILE] [--compare=FILE]"""
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('--records', type='int', default=20000,
+                      help="Number of records to encode for each "
+                      "combination. Default is 20000", metavar="N")
+    parser.add_option('--upload-records', type='int', default=2000,
+                      help="Number of records to upload for each "
+                      "configuration. Default is 2000", metavar="N")
+    parser.add_option('--output',
+                      help="Save the results as JSON in this file",
+                      metavar="FILE")
+    parser.add_option('--compare',
+                      help="Compare the results with those saved in this file",
+                      metavar="FILE")
+    (options, _) = parser.parse_args()
+
+    results = bench_encoder(options.records)
+    results += bench_upload(options.upload_records)
+    report = {
+        'version': user.influx.VERSION,
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'time': int(time.time()),
+        'results': results,
+    }
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if options.compare:
+        compare(results, options.compare)
+
+
+if __name__ == '__main__':
+    main()
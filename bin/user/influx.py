@@ -11,6 +11,9 @@ This is a weewx extension that uploads data to an Influx server.
 Database Configuration and Access
 
 When it starts up, this extension will attempt to create the influx database.
+This happens in the uploader thread, so weewx does not wait for it.  If the
+server cannot be reached, the uploader keeps trying, with longer and longer
+waits, and holds on to the data until the database has been created.
 
 To disable database creation, set create_database=False.
 
@@ -132,6 +135,14 @@ except ImportError:
     # Python 2
     import Queue as queue
 import base64
+import collections
+import email.utils
+import io
+import json
+import math
+import os
+import random
+import re
 from distutils.version import StrictVersion
 try:
     # Python 3
@@ -140,25 +151,39 @@ except ImportError:
     # Python 2
     import httplib as http_client
 import socket
+import sqlite3
 try:
     # Python 3
     from urllib.parse import urlparse, urlencode
     from urllib.request import urlopen, Request
     from urllib.error import HTTPError, URLError
+    from urllib.response import addinfourl
 except ImportError:
     # Python 2
     from urlparse import urlparse
-    from urllib import urlencode
+    from urllib import urlencode, addinfourl
     from urllib2 import urlopen, Request, HTTPError, URLError
     from httplib import BadStatusLine
 import sys
+import threading
+import time
+try:
+    # Python 3
+    from types import MappingProxyType as _read_only
+except ImportError:
+    # Python 2 has no read-only view of a dict, so use the dict itself
+    def _read_only(d):
+        return d
+import zlib
 
+import weedb
 import weewx
 import weewx.restx
 import weewx.units
-from weeutil.weeutil import to_bool, accumulateLeaves
+from weeutil.weeutil import to_bool, to_int, accumulateLeaves, timestamp_to_string
+from weeutil.weeutil import startOfDay
 
-VERSION = "0.17"
+VERSION = "0.18"
 
 REQUIRED_WEEWX = "3.5.0"
 if StrictVersion(weewx.__version__) < StrictVersion(REQUIRED_WEEWX):
@@ -219,26 +244,357 @@ UNIT_REDUCTIONS = {
 # observations that should be skipped when obs_to_upload is 'most'
 OBS_TO_SKIP = ['dateTime', 'interval', 'usUnits']
 
+# options that control how records are encoded.  when there are several
+# destinations, each record is encoded only once, so these options apply to
+# all of the destinations.  the timestamp precision is also used by every
+# destination, but each destination needs to know it.
+ENCODER_OPTIONS = ['line_format', 'measurement', 'tags', 'inputs',
+                   'unit_system', 'obs_to_upload', 'append_units_label',
+                   'augment_record', 'augment_cache', 'manager_dict',
+                   'post_interval', 'stale']
+
+# options used by the service before records reach the uploader.  the queue
+# options apply to the queue of each destination as well.
+SERVICE_OPTIONS = ['queue_size', 'overflow_policy', 'loop_window']
+
+# timestamp multipliers for each write precision
+PRECISION_SCALE = {
+    's': 1,
+    'ms': 1000,
+    'us': 1000000,
+    'ns': 1000000000,
+}
+
+# the version 1 write API uses different names for some precisions
+V1_PRECISION = {
+    's': 's',
+    'ms': 'ms',
+    'us': 'u',
+    'ns': 'n',
+}
+
+# zlib window bits for each supported Content-Encoding
+COMPRESSION_WBITS = {
+    'none': None,
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
 MAX_SIZE = 1000000
 
+# how long to wait for an answer to a ping, in seconds
+PING_TIMEOUT = 5
+
+# the longest wait between attempts to reach a server that is down, in
+# seconds
+MAX_RETRY_WAIT = 600
+
+# responses that mean the server is too busy, and may have a Retry-After
+THROTTLE_CODES = (429, 503)
+
+# client errors that may go away by trying again.  the server would answer
+# any other 4xx the same way the next time, so those posts are dropped.
+RETRY_CLIENT_CODES = (408,) + THROTTLE_CODES
+
+# when the server is too busy, batches are cut to this share of their size at
+# the least, and grow back by THROTTLE_STEP of their size after each post
+THROTTLE_MIN_SHARE = 0.01
+THROTTLE_STEP = 0.1
+
+# when the server is too busy, posts are limited to a rate that starts at half
+# of THROTTLE_MAX_RATE, in posts per second, and halves each time the server
+# is too busy again, down to THROTTLE_MIN_RATE.  After each post it grows by
+# THROTTLE_RATE_STEP, and at THROTTLE_MAX_RATE the limit is lifted.
+THROTTLE_MIN_RATE = 1.0
+THROTTLE_MAX_RATE = 10.0
+THROTTLE_RATE_STEP = 0.25
+
+# how influx names the lines that it rejected, in the message of a 400
+# response.  influx 1.x quotes each line that it could not parse, influx 2.x
+# numbers them, and both name the field of a field type conflict.  influx 3.x
+# lists the lines in the data of the response.
+REJECTED_LINE = re.compile(r"unable to parse '(.*?)': ", re.S)
+REJECTED_LINE_NUMBER = re.compile(r"^line (\d+):", re.M)
+FIELD_CONFLICT = re.compile(r'field type conflict: input field "(.*?)" on '
+                            r'measurement "(.*?)" is type (\w+)')
+
+# the largest body that each major version of influx accepts by default
+SERVER_MAX_BODY = {
+    1: 25000000,
+    2: 50000000,
+    3: 10485760,
+}
+
+# percentiles reported for each histogram of uploader metrics
+METRICS_PERCENTILES = [50, 99]
+
+# the default measurement for the uploader's own metrics
+METRICS_MEASUREMENT = '_weewx_influx'
+
+# when a deadband is specified for an observation, upload it at least this
+# often, in seconds, even if it has not changed
+DEADBAND_MAX_SILENCE = 600
+
+# when augmenting loop packets from a cache, look for new archive records at
+# most this often, in seconds
+AUGMENT_REFRESH = 60
+
 # return the units label for an observation
 def _get_units_label(obs, unit_system, unit_type=None):
     if unit_type is None:
         (unit_type, _) = weewx.units.getStandardUnitType(unit_system, obs)
     return UNIT_REDUCTIONS.get(unit_type, unit_type)
 
-# get the template for an observation based on the observation key
-def _get_template(obs_key, overrides, append_units_label, unit_system):
-    tmpl_dict = dict()
+# conversion functions, keyed by observation, unit system, and target unit
+_CONVERTERS = dict()
+
+# get a function that converts an observation from the units of the given
+# unit system to the target unit, or None if no conversion is needed.  the
+# function comes straight from the weewx conversion table, so converting a
+# value is a single call with no lookups or tuples.
+def _get_converter(obs_key, unit_system, to_units):
+    key = (obs_key, unit_system, to_units)
+    if key not in _CONVERTERS:
+        (from_unit, from_group) = weewx.units.getStandardUnitType(
+            unit_system, obs_key)
+        if from_unit == to_units:
+            converter = None
+        else:
+            try:
+                converter = weewx.units.conversionDict[from_unit][to_units]
+            except KeyError:
+                # let weewx decide what to do with this combination
+                converter = lambda v: weewx.units.convert(
+                    (v, from_unit, from_group), to_units)[0]
+        _CONVERTERS[key] = converter
+    return _CONVERTERS[key]
+
+# escape the characters that are special in a line protocol measurement name
+def _escape_measurement(name):
+    return name.replace(',', r'\,').replace(' ', r'\ ')
+
+# escape the characters that are special in a line protocol field key
+def _escape_key(name):
+    return _escape_measurement(name).replace('=', r'\=')
+
+# get the template for an observation based on the observation key.  the
+# template is an encoder with everything needed to format the observation
+# worked out ahead of time.  if a target unit system is specified, values are
+# converted from the record's unit system to the target unit system, unless
+# the overrides specify other units.
+def _get_template(obs_key, overrides, append_units_label, unit_system,
+                  line_format='single-line', measurement='record',
+                  target_system=None):
+    if target_system is None:
+        target_system = unit_system
+    name = obs_key
+    to_units = overrides.get('units')
     if append_units_label:
-        unit_type = overrides.get('units')
-        label = _get_units_label(obs_key, unit_system, unit_type)
+        label = _get_units_label(obs_key, target_system, to_units)
         if label is not None:
-            tmpl_dict['name'] = "%s_%s" % (obs_key, label)
-    for x in ['name', 'format', 'units']:
-        if x in overrides:
-            tmpl_dict[x] = overrides[x]
-    return tmpl_dict
+            name = "%s_%s" % (obs_key, label)
+    name = overrides.get('name', name)
+    if to_units is None and target_system != unit_system:
+        (to_units, _) = weewx.units.getStandardUnitType(target_system,
+                                                        obs_key)
+    if line_format == 'multi-line-dotted':
+        # use multiple lines with a dotted-name identifier
+        prefix = _escape_measurement("%s.%s" % (measurement, name))
+    elif line_format == 'multi-line':
+        # use multiple lines
+        prefix = _escape_measurement(name)
+    else:
+        # use a single line
+        prefix = "%s=" % _escape_key(name)
+    converter = None
+    if obs_key == 'usUnits' and target_system != unit_system:
+        converter = lambda v: float(target_system)
+    elif to_units is not None:
+        converter = _get_converter(obs_key, unit_system, to_units)
+    return ObsEncoder(obs_key, prefix, overrides.get('format', '%s'),
+                      converter, _get_deadband(overrides))
+
+# get the deadband for an observation from its overrides, as a tuple of
+# threshold, whether the threshold is relative to the last value uploaded, and
+# the maximum number of seconds between uploads.  the threshold is absolute,
+# in the units that are uploaded, or relative if it ends with a percent sign.
+def _get_deadband(overrides):
+    threshold = overrides.get('deadband')
+    if threshold is None:
+        return None
+    threshold = str(threshold).strip()
+    relative = threshold.endswith('%')
+    if relative:
+        threshold = float(threshold[:-1]) / 100.0
+    else:
+        threshold = float(threshold)
+    max_silence = to_int(overrides.get('max_silence', DEADBAND_MAX_SILENCE))
+    return threshold, relative, max_silence
+
+
+class ObsEncoder(object):
+    """Format the value of a single observation.  For the single-line format
+    the prefix is the field key and equals sign; for the multi-line formats
+    it is the measurement name."""
+
+    __slots__ = ('obs', 'prefix', 'fmt', 'converter', 'deadband')
+
+    def __init__(self, obs, prefix, fmt='%s', converter=None, deadband=None):
+        self.obs = obs
+        self.prefix = prefix
+        self.fmt = fmt
+        self.converter = converter
+        self.deadband = deadband
+
+    def value(self, v):
+        v = float(v)
+        if self.converter is not None:
+            v = self.converter(v)
+        return v
+
+    def encode(self, v):
+        return self.fmt % self.value(v)
+
+# get the uploader parameters from the Influx section of the configuration
+def _get_site_dict(cfg_dict):
+    site_dict = weewx.restx.get_site_dict(cfg_dict, 'Influx', 'database')
+    if site_dict is None:
+        return None
+
+    port = int(site_dict.get('port', 8086))
+    host = site_dict.get('host', 'localhost')
+    if site_dict.get('server_url', None) is None:
+        site_dict['server_url'] = 'http://%s:%s' % (host, port)
+    site_dict.pop('host', None)
+    site_dict.pop('port', None)
+    site_dict.setdefault('username', None)
+    site_dict.setdefault('password', '')
+    site_dict.setdefault('dbadmin_username', None)
+    site_dict.setdefault('dbadmin_password', '')
+    site_dict.setdefault('create_database', True)
+    site_dict.setdefault('tags', None)
+    site_dict.setdefault('line_format', 'single-line')
+    site_dict.setdefault('obs_to_upload', 'most')
+    site_dict.setdefault('append_units_label', True)
+    site_dict.setdefault('augment_record', True)
+    site_dict.setdefault('measurement', 'record')
+    site_dict.setdefault('batch_size', 1)
+    site_dict.setdefault('batch_max_bytes', 1000000)
+    site_dict.setdefault('batch_linger', 0)
+    site_dict.setdefault('keep_alive', True)
+    site_dict.setdefault('idle_timeout', 30)
+    site_dict.setdefault('compression', 'none')
+    site_dict.setdefault('compression_level', 6)
+    site_dict.setdefault('compression_min_size', 1024)
+
+    site_dict.setdefault('queue_size', 10000)
+    site_dict.setdefault('overflow_policy', 'drop_loop')
+    site_dict.setdefault('loop_window', 0)
+    site_dict.setdefault('api_version', 1)
+    site_dict.setdefault('precision', 'ns')
+
+    loginf("api_version: %s" % site_dict['api_version'])
+    loginf("database: %s" % site_dict['database'])
+    if str(site_dict['api_version']).lower() in ['2', 'auto']:
+        loginf("org: %s" % site_dict.get('org'))
+        loginf("bucket: %s" % site_dict.get('bucket', site_dict['database']))
+    loginf("precision: %s" % site_dict['precision'])
+    loginf("destination: %s" % site_dict['server_url'])
+    loginf("line_format: %s" % site_dict['line_format'])
+    loginf("measurement: %s" % site_dict['measurement'])
+    loginf("batch_size: %s" % site_dict['batch_size'])
+    loginf("compression: %s" % site_dict['compression'])
+    if site_dict.get('engine'):
+        loginf("engine: %s" % site_dict['engine'])
+    if site_dict.get('spool_file'):
+        loginf("spool_file: %s" % site_dict['spool_file'])
+    if site_dict.get('dead_letter_file'):
+        loginf("dead_letter_file: %s" % site_dict['dead_letter_file'])
+    if site_dict.get('metrics'):
+        loginf("metrics: %s" % site_dict['metrics'])
+
+    site_dict['append_units_label'] = to_bool(
+        site_dict.get('append_units_label'))
+    site_dict['augment_record'] = to_bool(site_dict.get('augment_record'))
+    site_dict['augment_cache'] = to_bool(site_dict.get('augment_cache', True))
+
+    usn = site_dict.get('unit_system', None)
+    if usn in weewx.units.unit_constants:
+        site_dict['unit_system'] = weewx.units.unit_constants[usn]
+        loginf("desired unit system: %s" % usn)
+
+    if 'inputs' in cfg_dict['StdRESTful']['Influx']:
+        site_dict['inputs'] = dict(
+            cfg_dict['StdRESTful']['Influx']['inputs'])
+
+    if 'destinations' in cfg_dict['StdRESTful']['Influx']:
+        site_dict['destinations'] = dict(
+            cfg_dict['StdRESTful']['Influx']['destinations'])
+
+    # if we are supposed to augment the record with data from weather
+    # tables, then get the manager dict to do it.  there may be no weather
+    # tables, so be prepared to fail.
+    try:
+        if site_dict.get('augment_record'):
+            _manager_dict = weewx.manager.get_manager_dict_from_config(
+                cfg_dict, 'wx_binding')
+            site_dict['manager_dict'] = _manager_dict
+    except weewx.UnknownBinding:
+        pass
+
+    if 'tags' in site_dict:
+        if isinstance(site_dict['tags'], list):
+            site_dict['tags'] = ','.join(site_dict['tags'])
+        loginf("tags: %s" % site_dict['tags'])
+
+    return site_dict
+
+# get the parameters for each destination.  each destination starts with the
+# parameters of the Influx section, minus those that control how records are
+# encoded, then overrides whatever it specifies.  each destination needs a
+# spool of its own, so a spool_file from the Influx section gets the name of
+# the destination added to it.
+def _get_destinations(cfg_dict, site_dict):
+    dest_dicts = []
+    spool_files = set()
+    destinations = site_dict.pop('destinations', None) or dict()
+    for name in destinations:
+        overrides = dict(destinations[name])
+        for x in ENCODER_OPTIONS + SERVICE_OPTIONS + ['precision']:
+            if x in overrides:
+                loginf("destination %s: ignoring %s, which applies to all "
+                       "destinations" % (name, x))
+                overrides.pop(x)
+        if 'server_url' not in overrides and (
+                'host' in overrides or 'port' in overrides):
+            cfg = cfg_dict['StdRESTful']['Influx']
+            host = overrides.get('host', cfg.get('host', 'localhost'))
+            port = int(overrides.get('port', cfg.get('port', 8086)))
+            overrides['server_url'] = 'http://%s:%s' % (host, port)
+        overrides.pop('host', None)
+        overrides.pop('port', None)
+        dest_dict = dict(site_dict)
+        for x in ENCODER_OPTIONS:
+            # the tags also identify the uploader's own metrics points
+            if x != 'tags':
+                dest_dict.pop(x, None)
+        dest_dict.update(overrides)
+        dest_dict['destination'] = name
+        if dest_dict.get('spool_file'):
+            if 'spool_file' not in overrides:
+                (root, ext) = os.path.splitext(dest_dict['spool_file'])
+                dest_dict['spool_file'] = '%s-%s%s' % (root, name, ext)
+            if dest_dict['spool_file'] in spool_files:
+                raise weewx.ViolatedPrecondition(
+                    "destination %s: spool_file %s is used by another "
+                    "destination" % (name, dest_dict['spool_file']))
+            spool_files.add(dest_dict['spool_file'])
+            loginf("destination %s: spool_file %s" %
+                   (name, dest_dict['spool_file']))
+        loginf("destination %s: %s database %s" %
+               (name, dest_dict['server_url'], dest_dict['database']))
+        dest_dicts.append(dest_dict)
+    return dest_dicts
 
 
 class Influx(weewx.restx.StdRESTbase):
@@ -267,7 +623,9 @@ class Influx(weewx.restx.StdRESTbase):
         measurement.  tags cannot contain spaces.
         Default is None
 
-        create_database: should the upload attempt to create database first
+        create_database: should the upload attempt to create database first.
+        This is done by the uploader thread, which waits for the server to
+        answer a ping, with exponential backoff, before posting any data.
         Default is True
 
         line_format: which line protocol format to use.  Possible values are
@@ -284,83 +642,184 @@ class Influx(weewx.restx.StdRESTbase):
         Default is most
 
         inputs: dictionary of weewx observation names with optional upload
-        name, format, and units
+        name, format, and units.  An observation can also have a deadband,
+        in which case it is uploaded only when it differs from the last value
+        uploaded by more than the deadband, or when max_silence seconds have
+        passed.  The deadband is in the units that are uploaded, or is
+        relative to the last value if it ends with %.  The default
+        max_silence is 600.
         Default is None
 
         binding: options include "loop", "archive", or "loop,archive"
         Default is archive
+
+        batch_size: maximum number of records to send in a single POST
+        Default is 1
+
+        batch_max_bytes: maximum size of the body of a single POST, in bytes.
+        auto means the largest body that the server accepts by default.
+        Default is 1000000
+
+        batch_linger: how long to wait for more records to arrive before
+        sending a partial batch, in seconds
+        Default is 0
+
+        keep_alive: should the connection to the server be kept open and
+        reused from one POST to the next
+        Default is True
+
+        idle_timeout: close a kept-alive connection that has not been used
+        for this many seconds
+        Default is 30
+
+        compression: how to compress the body of each POST.  Possible values
+        are none, gzip, deflate, or auto.  auto means gzip if the server
+        identifies itself as influx, otherwise none.
+        Default is none
+
+        compression_level: 1 (fastest) to 9 (smallest)
+        Default is 6
+
+        compression_min_size: bodies smaller than this many bytes are sent
+        without compression
+        Default is 1024
+
+        spool_file: path to a file in which records are kept until they have
+        been accepted by the server.  Records in the spool survive a restart.
+        Default is None (records that cannot be uploaded are discarded)
+
+        dead_letter_file: path to a file to which lines that the server
+        rejected are appended, so that they can be fixed and uploaded later.
+        The rest of the post is sent again right away.
+        Default is None (rejected lines are discarded)
+
+        augment_cache: when augmenting records, keep the rain totals from the
+        database in memory instead of querying the database for every record
+        Default is True
+
+        engine: how to do the uploads.  Possible values are thread or asyncio.
+        The thread engine posts one batch at a time.  The asyncio engine
+        (python 3 only) can have several posts in progress at once.
+        Default is thread
+
+        max_in_flight: for the asyncio engine, the maximum number of posts
+        that can be in progress at once
+        Default is 4
+
+        api_version: which influx write API to use.  1 is the /write API of
+        influx 1.x.  2 is the /api/v2/write API of influx 2.x and 3.x, which
+        uses org, bucket, and token instead of database and credentials.
+        auto means 2 if the server is influx 2.x or later and a token (and
+        for influx 2.x an org) is specified, otherwise 1.
+        Default is 1
+
+        org: for api_version 2, the organization that owns the bucket
+        Default is None
+
+        bucket: for api_version 2, the bucket to which data are written
+        Default is the database
+
+        token: for api_version 2, the API token used for authorization
+        Default is None
+
+        precision: the precision of the timestamps.  Possible values are s,
+        ms, us, or ns.  weewx timestamps are whole seconds, so s results in
+        the smallest data.
+        Default is ns
+
+        queue_size: the maximum number of records waiting to be uploaded.
+        0 means no limit.
+        Default is 10000
+
+        overflow_policy: what to do when the queue is full.  Possible values
+        are drop_oldest, drop_loop, or coalesce.  drop_oldest discards the
+        oldest record.  drop_loop discards the oldest loop packet, so that
+        archive records are kept.  coalesce merges a new loop packet into the
+        loop packet before it, if there is one, otherwise does drop_loop.
+        Default is drop_loop
+
+        loop_window: combine the loop packets in each window of this many
+        seconds into a single point.  Each observation is reduced using the
+        reducer in its inputs, which can be last, mean, circular_mean, min,
+        max, or sum.  The default reducer is sum for rain, max for windGust,
+        circular_mean for directions, and last for everything else.  If
+        extremes is True in the inputs for an observation, the minimum and
+        maximum in the window are added as <obs>_min and <obs>_max.
+        Default is 0 (upload every loop packet)
+
+        metrics: where to report metrics about the uploads, such as queue
+        depth, post latency, bytes sent, and failures.  Any of log, json,
+        or influx.  The influx metrics are written with the data, using the
+        same tags.
+        Default is None
+
+        metrics_interval: how often to report metrics, in seconds
+        Default is 300
+
+        metrics_file: the file to which json metrics are written
+        Default is None
+
+        metrics_measurement: the measurement for influx metrics
+        Default is _weewx_influx
+
+        destinations: dictionary of destinations, each with any of the
+        parameters that control where and how data are posted.  Each record
+        is encoded once, then posted to every destination by a separate
+        thread with its own queue, batching, spool, and retries.
+        Default is None (post only to the server_url)
         """
         super(Influx, self).__init__(engine, cfg_dict)
         loginf("service version is %s" % VERSION)
-        site_dict = weewx.restx.get_site_dict(cfg_dict, 'Influx', 'database')
+        self.writer_threads = []
+        self.aggregator = None
+        site_dict = _get_site_dict(cfg_dict)
         if site_dict is None:
             return
 
-
-        port = int(site_dict.get('port', 8086))
-        host = site_dict.get('host', 'localhost')
-        if site_dict.get('server_url', None) is None:
-            site_dict['server_url'] = 'http://%s:%s' % (host, port)
-        site_dict.pop('host', None)
-        site_dict.pop('port', None)
-        site_dict.setdefault('username', None)
-        site_dict.setdefault('password', '')
-        site_dict.setdefault('dbadmin_username', None)
-        site_dict.setdefault('dbadmin_password', '')
-        site_dict.setdefault('create_database', True)
-        site_dict.setdefault('tags', None)
-        site_dict.setdefault('line_format', 'single-line')
-        site_dict.setdefault('obs_to_upload', 'most')
-        site_dict.setdefault('append_units_label', True)
-        site_dict.setdefault('augment_record', True)
-        site_dict.setdefault('measurement', 'record')
-
-        loginf("database: %s" % site_dict['database'])
-        loginf("destination: %s" % site_dict['server_url'])
-        loginf("line_format: %s" % site_dict['line_format'])
-        loginf("measurement: %s" % site_dict['measurement'])
-
-        site_dict['append_units_label'] = to_bool(
-            site_dict.get('append_units_label'))
-        site_dict['augment_record'] = to_bool(site_dict.get('augment_record'))
-
-        usn = site_dict.get('unit_system', None)
-        if usn in weewx.units.unit_constants:
-            site_dict['unit_system'] = weewx.units.unit_constants[usn]
-            loginf("desired unit system: %s" % usn)
-
-        if 'inputs' in cfg_dict['StdRESTful']['Influx']:
-            site_dict['inputs'] = dict(
-                cfg_dict['StdRESTful']['Influx']['inputs'])
-
-        # if we are supposed to augment the record with data from weather
-        # tables, then get the manager dict to do it.  there may be no weather
-        # tables, so be prepared to fail.
-        try:
-            if site_dict.get('augment_record'):
-                _manager_dict = weewx.manager.get_manager_dict_from_config(
-                    cfg_dict, 'wx_binding')
-                site_dict['manager_dict'] = _manager_dict
-        except weewx.UnknownBinding:
-            pass
-
-        if 'tags' in site_dict:
-            if isinstance(site_dict['tags'], list):
-                site_dict['tags'] = ','.join(site_dict['tags'])
-            loginf("tags: %s" % site_dict['tags'])
-
         # we can bind to loop packets and/or archive records
         binding = site_dict.pop('binding', 'archive')
         if isinstance(binding, list):
             binding = ','.join(binding)
         loginf('binding: %s' % binding)
 
-        data_queue = queue.Queue()
+        queue_size = to_int(site_dict.pop('queue_size'))
+        overflow_policy = site_dict.pop('overflow_policy')
+        loginf("queue_size: %s" % queue_size)
+        loginf("overflow_policy: %s" % overflow_policy)
+        loop_window = to_int(site_dict.pop('loop_window'))
+
+        destinations = _get_destinations(cfg_dict, site_dict)
+
         try:
-            data_thread = InfluxThread(data_queue, **site_dict)
+            if loop_window and 'loop' in binding.lower():
+                loginf("loop_window: %s" % loop_window)
+                self.aggregator = LoopAggregator(loop_window,
+                                                 site_dict.get('inputs'))
+            data_queue = InfluxQueue(queue_size, overflow_policy)
+            if destinations:
+                writer_queues = []
+                for dest_dict in destinations:
+                    # records for a destination are already encoded, so
+                    # there is no telling loop from archive.
+                    writer_queue = InfluxQueue(queue_size, 'drop_oldest')
+                    self.writer_threads.append(
+                        InfluxThread(writer_queue, **dest_dict))
+                    writer_queues.append(writer_queue)
+                data_thread = InfluxEncoderThread(data_queue, writer_queues,
+                                                  **site_dict)
+                # a writer that loses records must be able to reset the
+                # deadband of the encoder
+                for t in self.writer_threads:
+                    t.last_uploaded = data_thread.last_uploaded
+            else:
+                data_thread = InfluxThread(data_queue, **site_dict)
         except weewx.ViolatedPrecondition as e:
             loginf("Data will not be posted: %s" % e)
+            self.writer_threads = []
+            self.aggregator = None
             return
+        for t in self.writer_threads:
+            t.start()
         data_thread.start()
 
         if 'loop' in binding.lower():
@@ -371,17 +830,242 @@ class Influx(weewx.restx.StdRESTbase):
             self.archive_queue = data_queue
             self.archive_thread = data_thread
             self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
-        loginf("Data will be uploaded to %s" % site_dict['server_url'])
+        if destinations:
+            for dest_dict in destinations:
+                loginf("Data will be uploaded to %s" % dest_dict['server_url'])
+        else:
+            loginf("Data will be uploaded to %s" % site_dict['server_url'])
 
     def new_loop_packet(self, event):
-        data = {'binding': 'loop'}
-        data.update(event.packet)
-        self.loop_queue.put(data)
+        packet = event.packet
+        if self.aggregator is not None:
+            packet = self.aggregator.add(packet)
+            if packet is None:
+                return
+        self.loop_queue.put(QueuedRecord('loop', packet))
 
     def new_archive_record(self, event):
-        data = {'binding': 'archive'}
-        data.update(event.record)
-        self.archive_queue.put(data)
+        self.archive_queue.put(QueuedRecord('archive', event.record))
+
+    def shutDown(self):
+        # send whatever is in the last loop window before the threads stop
+        if self.aggregator is not None:
+            packet = self.aggregator.flush()
+            if packet is not None:
+                self.loop_queue.put(QueuedRecord('loop', packet))
+        # the encoder thread tells the writer threads to stop when it stops
+        super(Influx, self).shutDown()
+        for t in self.writer_threads:
+            t.join(20.0)
+            if t.is_alive():
+                logerr("Unable to shut down thread for %s" % t.destination)
+
+
+class QueuedRecord(object):
+    """A loop packet or archive record as it waits in the queue, with the
+    binding it came from.  The packet is not copied.  The uploader sees it
+    through a read-only view, and makes its own copy if it needs to add
+    anything."""
+
+    __slots__ = ('binding', 'record')
+
+    def __init__(self, binding, record):
+        self.binding = binding
+        self.record = _read_only(record)
+
+
+class LoopAggregator(object):
+    """Combine the loop packets in each window of a number of seconds into
+    a single packet.  Windows start at multiples of the window length, and the
+    packet for a window is emitted when the first packet of the next window
+    arrives, with the timestamp of the last packet in the window.  Values that
+    are not numbers are reduced to the last value.  Unless the inputs say
+    otherwise, rain is summed, gusts take the maximum, directions take the
+    circular mean, and everything else takes the last value, which is right
+    for counters such as dayRain."""
+
+    REDUCERS = ['last', 'mean', 'circular_mean', 'min', 'max', 'sum']
+
+    def __init__(self, window, inputs=None):
+        self.window = window
+        self.reducers = {'rain': 'sum', 'windGust': 'max'}
+        for obs in weewx.units.obs_group_dict:
+            if weewx.units.obs_group_dict[obs] == 'group_direction':
+                self.reducers[obs] = 'circular_mean'
+        self.extremes = set()
+        inputs = inputs or dict()
+        for obs in inputs:
+            reducer = inputs[obs].get('reducer')
+            if reducer is not None:
+                if reducer not in self.REDUCERS:
+                    raise weewx.ViolatedPrecondition(
+                        "unknown reducer '%s' for %s" % (reducer, obs))
+                self.reducers[obs] = reducer
+            if to_bool(inputs[obs].get('extremes', False)):
+                self.extremes.add(obs)
+                # the extremes have the same units as the observation
+                group = weewx.units.obs_group_dict.get(obs)
+                if group is not None:
+                    weewx.units.obs_group_dict.setdefault(obs + '_min', group)
+                    weewx.units.obs_group_dict.setdefault(obs + '_max', group)
+        self.start = None
+        # for each observation: last value, sum, count, minimum, maximum, and
+        # the sums of the sines and cosines, for directions
+        self.stats = dict()
+
+    def add(self, packet):
+        """Add a loop packet.  Return the packet for the previous window if
+        this packet starts a new one, otherwise None."""
+        start = packet['dateTime'] // self.window * self.window
+        data = None
+        if self.stats and (start != self.start or packet.get('usUnits') !=
+                           self.stats.get('usUnits', [None])[0]):
+            data = self.flush()
+        self.start = start
+        for obs in packet:
+            v = packet[obs]
+            s = self.stats.get(obs)
+            if s is None:
+                s = self.stats[obs] = [None, 0.0, 0, None, None, 0.0, 0.0]
+            s[0] = v
+            try:
+                x = float(v)
+            except (TypeError, ValueError):
+                continue
+            s[1] += x
+            s[2] += 1
+            if s[3] is None or x < s[3]:
+                s[3] = x
+            if s[4] is None or x > s[4]:
+                s[4] = x
+            s[5] += math.sin(math.radians(x))
+            s[6] += math.cos(math.radians(x))
+        return data
+
+    def flush(self):
+        """Return the packet for the current window, if there is one, and
+        start over."""
+        if not self.stats:
+            return None
+        data = dict()
+        for obs in self.stats:
+            (last, total, count, lo, hi, sin, cos) = self.stats[obs]
+            reducer = self.reducers.get(obs, 'last')
+            if not count or obs in OBS_TO_SKIP or reducer == 'last':
+                data[obs] = last
+            elif reducer == 'mean':
+                data[obs] = total / count
+            elif reducer == 'circular_mean':
+                if abs(sin) < 1e-9 and abs(cos) < 1e-9:
+                    # directions that cancel out have no mean
+                    data[obs] = last
+                else:
+                    data[obs] = math.degrees(math.atan2(sin, cos)) % 360.0
+            elif reducer == 'sum':
+                data[obs] = total
+            elif reducer == 'min':
+                data[obs] = lo
+            else:
+                data[obs] = hi
+            if count and obs in self.extremes:
+                data[obs + '_min'] = lo
+                data[obs + '_max'] = hi
+        self.stats = dict()
+        return data
+
+
+class InfluxQueue(queue.Queue):
+    """A queue that holds no more than maxsize records, but never blocks the
+    thread that puts records into it.  When the queue is full, the overflow
+    policy decides what to give up, and the losses are counted by binding in
+    the dropped dictionary, and in coalesced."""
+
+    POLICIES = ['drop_oldest', 'drop_loop', 'coalesce']
+
+    # how often to report losses, in seconds
+    REPORT_INTERVAL = 300
+
+    def __init__(self, maxsize=0, policy='drop_loop'):
+        if policy not in self.POLICIES:
+            raise weewx.ViolatedPrecondition(
+                "unknown overflow_policy '%s'" % policy)
+        # the base class must not block, so it does not get the maxsize
+        queue.Queue.__init__(self)
+        self.limit = maxsize
+        self.policy = policy
+        self.dropped = {'loop': 0, 'archive': 0, None: 0}
+        self.coalesced = 0
+        self.last_report = 0
+
+    def put(self, item, block=True, timeout=None):
+        with self.not_full:
+            if (item is not None and self.limit and
+                    self._qsize() >= self.limit and
+                    not self._make_room(item)):
+                # the item was merged or dropped
+                return
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _make_room(self, item):
+        """Make room for the item.  Return False if the item itself was
+        merged into another or discarded."""
+        binding = _get_binding(item)
+        if self.policy == 'coalesce' and binding == 'loop':
+            last = self.queue[-1]
+            if _get_binding(last) == 'loop':
+                self.queue[-1] = _coalesce(last, item)
+                self.coalesced += 1
+                self._report()
+                return False
+        if self.policy in ['drop_loop', 'coalesce']:
+            for i, x in enumerate(self.queue):
+                if _get_binding(x) == 'loop':
+                    del self.queue[i]
+                    self._count('loop')
+                    return True
+            if binding == 'loop':
+                self._count('loop')
+                return False
+        for i, x in enumerate(self.queue):
+            if x is not None:
+                del self.queue[i]
+                self._count(_get_binding(x))
+                return True
+        return True
+
+    def _count(self, binding):
+        self.dropped[binding] = self.dropped.get(binding, 0) + 1
+        self._report()
+
+    def _report(self):
+        now = time.time()
+        if now - self.last_report >= self.REPORT_INTERVAL:
+            self.last_report = now
+            logerr("queue is full: dropped %d loop, %d archive, %d other; "
+                   "coalesced %d" %
+                   (self.dropped['loop'], self.dropped['archive'],
+                    self.dropped[None], self.coalesced))
+
+
+# get the binding of an item in a queue
+def _get_binding(item):
+    if isinstance(item, QueuedRecord):
+        return item.binding
+    return None
+
+# merge two queued loop packets.  the newer values win, except for rain,
+# which is the amount since the previous packet, so it is added up.
+def _coalesce(older, newer):
+    older = older.record
+    data = dict(older)
+    data.update(newer.record)
+    if older.get('rain') is not None and data.get('rain') is not None:
+        data['rain'] = older['rain'] + data['rain']
+    elif older.get('rain') is not None:
+        data['rain'] = older['rain']
+    return QueuedRecord('loop', data)
 
 
 class InfluxThread(weewx.restx.RESTThread):
@@ -393,10 +1077,19 @@ class InfluxThread(weewx.restx.RESTThread):
                  dbadmin_username=None, dbadmin_password=None,
                  line_format='single-line', create_database=True,
                  measurement='record', tags=None,
-                 unit_system=None, augment_record=True,
+                 unit_system=None, augment_record=True, augment_cache=True,
                  inputs=dict(), obs_to_upload='most', append_units_label=True,
                  server_url=_DEFAULT_SERVER_URL, skip_upload=False,
                  manager_dict=None,
+                 batch_size=1, batch_max_bytes=1000000, batch_linger=0,
+                 keep_alive=True, idle_timeout=30,
+                 compression='none', compression_level=6,
+                 compression_min_size=1024, spool_file=None,
+                 dead_letter_file=None, engine='thread', max_in_flight=4,
+                 destination=None,
+                 api_version=1, org=None, bucket=None, token=None,
+                 precision='ns', metrics=None, metrics_interval=300,
+                 metrics_file=None, metrics_measurement=None,
                  post_interval=None, max_backlog=MAX_SIZE, stale=None,
                  log_success=True, log_failure=True,
                  timeout=60, max_tries=3, retry_wait=5):
@@ -415,6 +1108,7 @@ class InfluxThread(weewx.restx.RESTThread):
         self.username = username
         self.password = password
         self.measurement = measurement
+        self._measurement = _escape_measurement(measurement)
         self.tags = tags
         self.obs_to_upload = obs_to_upload
         self.append_units_label = append_units_label
@@ -423,19 +1117,209 @@ class InfluxThread(weewx.restx.RESTThread):
         self.skip_upload = to_bool(skip_upload)
         self.unit_system = unit_system
         self.augment_record = augment_record
+        self.augment_cache = AugmentCache() if augment_cache else None
         self.templates = dict()
+        # the last value and time uploaded for observations with a deadband
+        self.last_uploaded = dict()
+        # records dropped by the queue, once they have been encoded
+        self.queue_dropped = 0
         self.line_format = line_format
-
-        if create_database:
-            uname = None
-            pword = None
-            if dbadmin_username:
-                uname = dbadmin_username
-                pword = dbadmin_password
-            elif username:
-                uname = username
-                pword = password
-            self.create_database(uname, pword)
+        self.batch_size = max(1, to_int(batch_size))
+        # settings that depend on the server are worked out when the server
+        # answers a ping.  until then, use what works with any server.
+        self.auto = set()
+        if str(batch_max_bytes).lower() == 'auto':
+            self.auto.add('batch_max_bytes')
+            batch_max_bytes = 1000000
+        self.batch_max_bytes = to_int(batch_max_bytes)
+        self.batch_linger = float(batch_linger)
+        self.keep_alive = to_bool(keep_alive)
+        self.idle_timeout = float(idle_timeout)
+        self._conn = None
+        self._conn_key = None
+        self._conn_used = 0
+        self.compression = (compression or 'none').lower()
+        if self.compression == 'auto':
+            self.auto.add('compression')
+            self.compression = 'none'
+        if self.compression not in COMPRESSION_WBITS:
+            raise weewx.ViolatedPrecondition(
+                "unknown compression '%s'" % compression)
+        self.compression_level = to_int(compression_level)
+        self.compression_min_size = to_int(compression_min_size)
+        self.spool_file = spool_file
+        self.spool = None
+        self.dead_letters = None
+        if dead_letter_file:
+            self.dead_letters = DeadLetterFile(dead_letter_file)
+        self.engine = (engine or 'thread').lower()
+        if self.engine not in ['thread', 'asyncio']:
+            raise weewx.ViolatedPrecondition("unknown engine '%s'" % engine)
+        if self.engine == 'asyncio' and sys.version_info < (3, 5):
+            raise weewx.ViolatedPrecondition(
+                "asyncio engine requires python 3")
+        self.max_in_flight = max(1, to_int(max_in_flight))
+        self.destination = destination
+        if str(api_version).lower() == 'auto':
+            self.auto.add('api_version')
+            api_version = 1
+        self.api_version = to_int(api_version)
+        if self.api_version not in [1, 2]:
+            raise weewx.ViolatedPrecondition(
+                "unknown api_version '%s'" % api_version)
+        self.org = org
+        self.bucket = bucket or database
+        self.token = token
+        self.precision = precision
+        if self.precision not in PRECISION_SCALE:
+            raise weewx.ViolatedPrecondition(
+                "unknown precision '%s'" % precision)
+        self.ts_scale = PRECISION_SCALE[self.precision]
+        self.metrics = UploadMetrics()
+        self.metrics_sinks = _get_metrics_sinks(metrics, metrics_file,
+                                                metrics_measurement)
+        self.metrics_interval = to_int(metrics_interval)
+        self.metrics_due = time.time() + self.metrics_interval
+        # metrics points waiting to go out with the next batch
+        self.metrics_points = []
+
+        # while the server is down, batches are held here, or in the spool
+        self.breaker = CircuitBreaker(self.retry_wait)
+        self.held = collections.deque()
+        self.backlog = False
+        # after an outage, the records that waited in the queue are sent in
+        # bulk until the queue is empty
+        self.catch_up = False
+
+        # slows down posts while the server says it is too busy
+        self.throttle = Throttle()
+
+        # the database or bucket is created by the uploader thread, before
+        # anything is posted, so that weewx does not have to wait for it
+        self.server_version = None
+        self.create = to_bool(create_database)
+        self.provisioned = not self.create and not self.auto
+        self.admin_username = username
+        self.admin_password = password
+        if dbadmin_username:
+            self.admin_username = dbadmin_username
+            self.admin_password = dbadmin_password
+
+    def provision(self, max_tries=None):
+        """Make sure that the database or bucket exists before posting
+        anything.  Ping the server first, since that fails quickly if the
+        server is not there, and tells what the server can do.  Then create
+        the database.  If the server cannot be reached, try again with
+        exponential backoff.  Records wait in the queue meanwhile.  Return
+        False if the thread was told to shut down before the database could
+        be created."""
+        tries = 0
+        while True:
+            tries += 1
+            try:
+                self.configure(self.ping())
+                if not self.create:
+                    pass
+                elif self.api_version == 2:
+                    self.create_bucket()
+                else:
+                    self.create_database(self.admin_username,
+                                         self.admin_password)
+                self.provisioned = True
+                self.breaker.success()
+                return True
+            except HTTPError as e:
+                if e.code < 500:
+                    # the server is there but will not do it, so do not ask
+                    # again.  posts will fail if the database is missing.
+                    logerr("create database failed: %s" % e)
+                    self.provisioned = True
+                    return True
+                err = e
+            except (socket.error, socket.timeout, URLError, ValueError,
+                    http_client.HTTPException) as e:
+                err = e
+            finally:
+                self.close_connection()
+            if max_tries is not None and tries >= max_tries:
+                logerr("create database failed: %s" % err)
+                return True
+            self.breaker.failure()
+            wait = self.breaker.wait_time()
+            logerr("server is not ready, trying again in %.0f seconds: %s" %
+                   (wait, err))
+            if self.wait_for_shutdown(wait):
+                return False
+
+    def configure(self, response):
+        """Note the version that the server reports in its answer to a ping,
+        and choose the settings that were left to the server.  A server that
+        does not report a version gets settings that work anywhere."""
+        self.server_version = response.info().get('X-Influxdb-Version')
+        major = None
+        try:
+            major = int(self.server_version.lstrip('vV').split('.')[0])
+        except (AttributeError, ValueError):
+            pass
+        build = response.info().get('X-Influxdb-Build')
+        loginf("server version: %s%s" % (
+            self.server_version, ' (%s)' % build if build else ''))
+        if major is not None and major >= 3 and self.create:
+            # influx 3 creates a database when something is written to it
+            self.create = False
+        if 'api_version' in self.auto:
+            # influx 2 needs an org.  influx 3 ignores it.
+            if (major is not None and major >= 2 and self.token and
+                    (self.org or major >= 3)):
+                self.api_version = 2
+            else:
+                self.api_version = 1
+            loginf("using api_version %s" % self.api_version)
+        if 'compression' in self.auto:
+            # every version of influx accepts gzip, but there is no telling
+            # what something else might do with it
+            self.compression = 'gzip' if major is not None else 'none'
+            loginf("using compression %s" % self.compression)
+        if 'batch_max_bytes' in self.auto:
+            self.batch_max_bytes = SERVER_MAX_BODY.get(
+                major, self.batch_max_bytes)
+            loginf("using batch_max_bytes %s" % self.batch_max_bytes)
+
+    def wait_for_shutdown(self, wait):
+        """Wait for up to the given number of seconds, reporting the metrics
+        when they are due.  Return True if the queue has been told to shut
+        down meanwhile.  The signal is left in the queue."""
+        deadline = time.time() + wait
+        while True:
+            with self.queue.mutex:
+                if None in self.queue.queue:
+                    return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            self.report_metrics()
+            time.sleep(min(1.0, remaining))
+
+    def ping(self):
+        """Ask the server whether it is up, without waiting long for an
+        answer.  Return the response."""
+        request = self.get_request('%s/ping' % self.server_url)
+        timeout = min(self.timeout, PING_TIMEOUT)
+        try:
+            if self.server_url.startswith('https'):
+                # FIXME: provide full set of ssl options instead of this hack
+                import ssl
+                response = urlopen(request, timeout=timeout,
+                                   context=ssl._create_unverified_context())
+            else:
+                response = urlopen(request, timeout=timeout)
+        except HTTPError as e:
+            # any answer other than a server error means the server is up
+            if e.code >= 500:
+                raise
+            response = e
+        response.read()
+        return response
 
     def create_database(self, username, password):
         # ensure that the database exists
@@ -445,35 +1329,494 @@ class InfluxThread(weewx.restx.RESTThread):
         req.add_header("User-Agent", "weewx/%s" % weewx.__version__)
         if username and password:
             # Create a base64 byte string with the authorization info
-            base64bytes = base64.b64encode(('%s:%s' % (self.username, self.password)).encode())
+            base64bytes = base64.b64encode(('%s:%s' % (username, password)).encode())
             # Add the authentication header to the request:
             req.add_header("Authorization", b"Basic %s" % base64bytes)
+        # The use of a GET to create a database has been deprecated.
+        # Include a dummy payload to force a POST.
+        self.post_request(req, 'None')
+
+    def create_bucket(self):
+        # ensure that the bucket exists.  this requires the id of the org,
+        # and a token that is allowed to read orgs and write buckets.
+        url = '%s/api/v2/orgs?%s' % (self.server_url,
+                                     urlencode({'org': self.org}))
+        response = self.post_request(self.get_request(url))
+        orgs = json.loads(response.read().decode()).get('orgs', [])
+        if not orgs:
+            logerr("create bucket failed: no org '%s'" % self.org)
+            return
+        req = self.get_request('%s/api/v2/buckets' % self.server_url)
+        req.add_header('Content-Type', 'application/json')
+        body = json.dumps({'orgID': orgs[0]['id'], 'name': self.bucket,
+                           'retentionRules': []})
         try:
-            # The use of a GET to create a database has been deprecated.
-            # Include a dummy payload to force a POST.
-            self.post_request(req, 'None')
-        except (socket.error, socket.timeout, URLError, http_client.BadStatusLine, http_client.IncompleteRead) as e:
-            logerr("create database failed: %s" % e)
-
-    def get_record(self, record, dbm):
+            self.post_request(req, body)
+        except HTTPError as e:
+            # 422 means that the bucket already exists
+            if e.code != 422:
+                raise
+
+    def run_loop(self, dbmanager=None):
+        """Override my superclass so that several queued records can be sent
+        in a single POST.  With a batch_size of 1, each record is posted as
+        soon as it arrives, just like the superclass does it.
+
+        If there is a spool, each batch is written to the spool before it is
+        posted, and removed only once the server has accepted it.  Anything
+        left in the spool from a previous run is sent first.
+
+        If a batch cannot be posted, the server is taken to be down.  Rather
+        than have each batch use up its own retries, nothing more is posted
+        until the circuit breaker says it is time to try again.  Meanwhile
+        batches are held in the spool.  If there is no spool, the batches
+        that failed are held in memory, and new records are left in the
+        queue, where queue_size and overflow_policy limit them.  When the
+        server answers, everything held is sent in bulk."""
+        try:
+            if self.spool_file:
+                self.spool = Spool(self.spool_file, self.max_backlog)
+                pending = self.spool.count()
+                if pending:
+                    loginf("%d records pending in spool" % pending)
+            if not self.provisioned and not self.provision():
+                return
+            if self.engine == 'asyncio':
+                # the asyncio engine is python 3 only, so load it only when
+                # it is wanted.  it has connections of its own, so do not
+                # hold on to the one used to create the database.
+                self.close_connection()
+                import user.influx_async
+                user.influx_async.AsyncEngine(self).run(dbmanager)
+                return
+            if self.spool is not None:
+                self.flush_spool()
+            while True:
+                batch = []
+                try:
+                    if (self.spool is None and self.held and
+                            not self.wait_for_shutdown(
+                                self.breaker.wait_time())):
+                        self.flush_held()
+                        continue
+                    done = self.get_batch(batch, dbmanager)
+                    self.take_metrics_points(batch)
+                    if self.spool is not None:
+                        if self.spool.add(batch):
+                            self.forget_uploaded()
+                        self.flush_spool()
+                    else:
+                        self.hold(batch)
+                        self.flush_held()
+                except Exception as e:
+                    # Some unknown exception occurred.  This is probably a
+                    # serious problem, so do what the superclass does and exit.
+                    logerr("Unexpected exception of type %s" % type(e))
+                    logerr("Thread terminating. Reason: %s" % e)
+                    return
+                if done:
+                    return
+        finally:
+            self.close_connection()
+            if self.spool is not None:
+                self.spool.close()
+                self.spool = None
+
+    def send_batch(self, batch, tries=None, ids=None):
+        """Post a batch and report the outcome.  Return False if the batch
+        should be tried again later, True if it was either accepted or
+        rejected for good.  If the server rejects some of the lines, the rest
+        are posted again right away, and the batch is left with just those.
+        If the batch came from the spool, ids are its rows, and are left with
+        the rows of the rest."""
+        while batch:
+            start = time.time()
+            try:
+                self.post_batch(batch, tries)
+            except RejectedPost as e:
+                batch[:] = self.reject_lines(batch, e, time.time() - start,
+                                             ids)
+                continue
+            except (weewx.restx.AbortedPost, weewx.restx.FailedPost) as e:
+                return self.report_batch(batch, e, time.time() - start)
+            return self.report_batch(batch, None, time.time() - start)
+        return True
+
+    def reject_lines(self, batch, e, elapsed=None, ids=None):
+        """The server rejected some or all of the lines in a batch.  Put the
+        rejected lines in the dead letter file and return the rest of the
+        batch.  If the response does not tell which lines were rejected, they
+        all were.  If the batch came from the spool, ids are its rows: the
+        rejected lines are taken out of them, and ids is left with the rows
+        of the rest."""
+        lines = []
+        for (_, body) in batch:
+            lines.extend(body.split('\n'))
+        rejected = _get_rejected(str(e), lines)
+        if not rejected:
+            rejected = set(range(len(lines)))
+        rest = []
+        bad = []
+        bad_lines = []
+        kept_ids = []
+        changed = []
+        removed = []
+        i = 0
+        for (k, entry) in enumerate(batch):
+            kept = []
+            for line in entry[1].split('\n'):
+                if i in rejected:
+                    bad_lines.append(line)
+                else:
+                    kept.append(line)
+                i += 1
+            if kept:
+                # keep metrics points as they are
+                rest.append(entry.__class__((entry[0], '\n'.join(kept))))
+            if len(kept) < entry[1].count('\n') + 1:
+                bad.append(entry)
+            if ids is None:
+                continue
+            if not kept:
+                removed.append(ids[k])
+            else:
+                kept_ids.append(ids[k])
+                if len(kept) < entry[1].count('\n') + 1:
+                    changed.append((rest[-1][1], ids[k]))
+        self.metrics.count('lines_rejected', len(bad_lines))
+        self.report_batch(bad, e, elapsed)
+        reason = ' '.join(str(e).split())
+        if self.log_failure:
+            logerr("Rejected %d of %d lines%s: %s" % (
+                len(bad_lines), len(lines),
+                ' by %s' % self.destination if self.destination else '',
+                reason))
+        if self.dead_letters is not None:
+            try:
+                self.dead_letters.write(bad_lines, reason, self.destination)
+            except (IOError, OSError) as x:
+                logerr("cannot write to %s: %s" %
+                       (self.dead_letters.filename, x))
+        if ids is not None:
+            # take the rejected lines out of the spool now, so that they are
+            # not rejected all over again if the rest cannot be posted yet
+            self.spool.rewrite(changed, removed)
+            ids[:] = kept_ids
+        return rest
+
+    def report_batch(self, batch, e=None, elapsed=None):
+        """Log the outcome of posting a batch.  Return False if the batch
+        failed and should be tried again later."""
+        self.metrics.add_post(batch, e, elapsed)
+        self.report_metrics()
+        what = self._describe(batch)
+        if self.destination:
+            what = '%s to %s' % (what, self.destination)
+        if isinstance(e, weewx.restx.FailedPost):
+            self.backlog = True
+            if (self.breaker.failure(self.throttle.wait_time())
+                    and self.log_failure):
+                logerr("Failed to publish %s: %s; trying again in %.0f "
+                       "seconds" % (what, e, self.breaker.wait_time()))
+            return False
+        if e is not None:
+            self.forget_uploaded()
+        if self.breaker.success():
+            self.catch_up = True
+            loginf("server is back%s" % (
+                ' for %s' % self.destination if self.destination else ''))
+        if e is None:
+            self.throttle.speed_up()
+        if isinstance(e, DroppedPost):
+            if self.log_failure:
+                logerr("Dropped %s: %s" % (what, e))
+        elif self.log_success:
+            if e is not None:
+                loginf("Skipped %s: %s" % (what, e))
+            else:
+                loginf("Published %s" % what)
+        return True
+
+    def report_metrics(self, force=False):
+        """Send the metrics to each sink, if it is time"""
+        if not self.metrics_sinks:
+            return
+        now = time.time()
+        if now < self.metrics_due and not force:
+            return
+        self.metrics_due = now + self.metrics_interval
+        values = self.metrics.report(self.queue)
+        values['batch_share'] = self.throttle.share
+        for sink in self.metrics_sinks:
+            try:
+                sink.emit(self, values)
+            except (IOError, OSError, TypeError, ValueError) as e:
+                logerr("cannot report metrics to %s: %s" %
+                       (sink.__class__.__name__, e))
+
+    def flush_spool(self):
+        """Send everything in the spool, oldest first, in batches of up to
+        batch_max_bytes.  Stop at the first batch that fails."""
+        while self.breaker.ready():
+            rows = self.spool.get(self.batch_limits()[1])
+            if not rows:
+                self.backlog = False
+                return
+            ids = [r[0] for r in rows]
+            if not self.send_batch([(ts, body) for (_, ts, body) in rows],
+                                   self.breaker.tries(), ids):
+                return
+            self.spool.remove(ids)
+
+    def hold(self, batch, first=False):
+        """Hold a batch in memory until it can be posted.  If there is too
+        much, the oldest records are dropped."""
+        if first:
+            self.held.extendleft(reversed(batch))
+        else:
+            self.held.extend(batch)
+        while len(self.held) > self.max_backlog:
+            self.held.popleft()
+            self.metrics.count('records_dropped')
+            self.forget_uploaded()
+
+    def take_held(self):
+        """Take a batch of up to batch_max_bytes from the held records"""
+        batch = []
+        nbytes = 0
+        max_bytes = self.batch_limits()[1]
+        while self.held and nbytes < max_bytes:
+            entry = self.held.popleft()
+            batch.append(entry)
+            nbytes += len(entry[1]) + 1
+        return batch
+
+    def flush_held(self):
+        """Send the held records, oldest first, in batches of up to
+        batch_max_bytes.  Stop at the first batch that fails."""
+        while self.held and self.breaker.ready():
+            batch = self.take_held()
+            if not self.send_batch(batch, self.breaker.tries()):
+                self.hold(batch, first=True)
+                return
+        if not self.held:
+            self.backlog = False
+
+    def get_batch(self, batch, dbmanager):
+        """Fill the batch with (dateTime, body) tuples from the queue.  Stop
+        when the batch has batch_size records or batch_max_bytes of data, or
+        when no new record arrives within batch_linger seconds of the first
+        one.  Return True if the queue has been told to shut down.  While the
+        server is too busy, batches are smaller."""
+        (batch_size, max_bytes) = self.batch_limits()
+        self.check_queue_drops()
+        nbytes = 0
+        deadline = None
+        if self.catch_up and not self.queue.empty():
+            # records that waited in the queue while the server was down are
+            # sent in batches of up to max_bytes, without waiting for more
+            batch_size = sys.maxsize
+            deadline = time.time()
+        else:
+            self.catch_up = False
+        while len(batch) < batch_size and nbytes < max_bytes:
+            if deadline is None:
+                # This will block until something appears in the queue, or
+                # until it is time to try the server again
+                try:
+                    _record = self.wait_for_record()
+                except queue.Empty:
+                    break
+            else:
+                try:
+                    _record = self.queue.get(
+                        timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+            # A None record is our signal to exit
+            if _record is None:
+                return True
+            entry = self.encode_record(_record, dbmanager)
+            if entry is None:
+                continue
+            batch.append(entry)
+            nbytes += len(entry[1]) + 1
+            if deadline is None:
+                deadline = time.time() + self.batch_linger
+        return False
+
+    def encode_record(self, record, dbmanager):
+        """Return a (dateTime, line protocol) tuple for a record taken from
+        the queue, or None if the record should not be uploaded.  Records
+        that were encoded already by an InfluxEncoderThread are tuples, and
+        are passed through as they are.  Anything else is a QueuedRecord, or
+        a plain record with no binding."""
+        # If records have backed up in the queue, discard the oldest ones
+        # until it is no bigger than the max allowed backlog
+        if self.queue.qsize() > self.max_backlog:
+            self.metrics.count('records_dropped')
+            if isinstance(record, tuple):
+                self.forget_uploaded()
+            return None
+        self.metrics.count('records_received')
+        if isinstance(record, tuple):
+            return record
+        binding = None
+        if isinstance(record, QueuedRecord):
+            binding = record.binding
+            record = record.record
+        if self.skip_this_post(record['dateTime']):
+            self.metrics.count('records_skipped')
+            return None
+        start = time.time()
+        _full_record = self.get_record(record, dbmanager, binding)
+        body, _ = self.get_post_body(_full_record, binding)
+        if not body:
+            self.metrics.count('records_skipped')
+            return None
+        self.metrics.count('records_encoded')
+        self.metrics.add('encode_time', time.time() - start)
+        return record['dateTime'], body
+
+    def take_metrics_points(self, batch):
+        """Move any metrics points into a batch of data.  Metrics are never
+        posted on their own, so posting them does not lead to more."""
+        if batch and self.metrics_points:
+            batch.extend(self.metrics_points)
+            self.metrics_points = []
+
+    def batch_limits(self):
+        """The most records, and the most bytes, to put in a batch now"""
+        share = self.throttle.share
+        return (max(1, int(self.batch_size * share)),
+                max(1, int(self.batch_max_bytes * share)))
+
+    def backlog_wait(self):
+        """How long to wait for a record before trying to send what has
+        been held, or None if nothing is held"""
+        if not self.backlog:
+            return None
+        # never less than a second, in case there turns out to be nothing
+        return max(1.0, self.breaker.wait_time())
+
+    def wait_for_record(self):
+        """Take the next record from the queue, reporting the metrics when
+        they are due while there is none.  Raise queue.Empty if it is time
+        to try sending what has been held instead."""
+        wait = self.backlog_wait()
+        deadline = None if wait is None else time.time() + wait
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, deadline - time.time())
+            if self.metrics_sinks:
+                # never less than a second, however short the interval
+                due = max(1.0, self.metrics_due - time.time())
+                timeout = due if timeout is None else min(timeout, due)
+            try:
+                return self.queue.get(timeout=timeout)
+            except queue.Empty:
+                if deadline is not None and time.time() >= deadline:
+                    raise
+            self.report_metrics()
+
+    def post_batch(self, batch, tries=None):
+        """Send the bodies in a batch as a single POST"""
+        request, data = self.get_batch_request(batch)
+        if self.skip_upload:
+            raise weewx.restx.AbortedPost("Skip post")
+        self.post_with_retries(request, data, tries)
+
+    def post_with_retries(self, request, data=None, tries=None):
+        """Same as my superclass, but with a limit on the number of tries,
+        so that a server that is down can be tried just once, and with waits
+        that honor the throttle"""
+        tries = tries or self.max_tries
+        for count in range(tries):
+            wait = self.throttle.reserve()
+            if count:
+                wait = max(wait, self.retry_wait)
+            if wait > 0 and self.wait_for_shutdown(wait):
+                raise weewx.restx.FailedPost("Shutting down")
+            try:
+                response = self.post_request(request, data)
+                if 200 <= response.code <= 299:
+                    self.check_response(response)
+                    return
+                self.handle_code(response.code, count + 1)
+            except (URLError, socket.error, http_client.HTTPException) as e:
+                self.handle_exception(e, count + 1)
+        raise weewx.restx.FailedPost("Failed upload after %d tries" % tries)
+
+    def get_batch_request(self, batch):
+        """Return the request and the data to post for a batch"""
+        data = '\n'.join([body for (_, body) in batch])
+        request = self.get_request(self.format_url(None))
+        request.add_header('Content-Type', 'application/x-www-form-urlencoded')
+        data = self.compress(data, request)
+        self.metrics.add('lines_per_post', len(batch))
+        self.metrics.add('bytes_per_post', len(data))
+        self.metrics.count('bytes_sent', len(data))
+        return request, data
+
+    def compress(self, data, request):
+        """Compress the data if it is big enough to be worth it, and mark the
+        request with the corresponding Content-Encoding."""
+        wbits = COMPRESSION_WBITS[self.compression]
+        if wbits is None or len(data) < self.compression_min_size:
+            return data
+        c = zlib.compressobj(self.compression_level, zlib.DEFLATED, wbits)
+        compressed = c.compress(data.encode('utf-8')) + c.flush()
+        request.add_header('Content-Encoding', self.compression)
+        return compressed
+
+    @staticmethod
+    def _describe(batch):
+        # metrics points are not worth mentioning
+        batch = [x for x in batch if not isinstance(x, MetricsPoint)]
+        if not batch:
+            return 'no records'
+        if len(batch) == 1:
+            return 'record %s' % timestamp_to_string(batch[0][0])
+        return '%d records %s to %s' % (len(batch),
+                                        timestamp_to_string(batch[0][0]),
+                                        timestamp_to_string(batch[-1][0]))
+
+    def get_record(self, record, dbm, binding=None):
         # We allow the superclass to add stuff to the record only if the user
-        # requests it
+        # requests it.  Either way makes a copy, so the record from the queue
+        # is never changed.
         if self.augment_record and dbm:
-            record = super(InfluxThread, self).get_record(record, dbm)
-        if self.unit_system is not None:
-            record = weewx.units.to_std_system(record, self.unit_system)
+            augmented = None
+            if self.augment_cache is not None:
+                augmented = self.augment_cache.augment(record, dbm, binding)
+            if augmented is None:
+                augmented = super(InfluxThread, self).get_record(record, dbm)
+            record = augmented
+        # conversion to the desired unit system is done by the templates, and
+        # only for the observations that are actually uploaded.
         return record
 
     def format_url(self, _):
+        if self.api_version == 2:
+            return '%s/api/v2/write?%s' % (self.server_url, urlencode(
+                [('org', self.org or ''), ('bucket', self.bucket),
+                 ('precision', self.precision)]))
+        if self.precision != 'ns':
+            return '%s/write?db=%s&precision=%s' % (
+                self.server_url, self.database, V1_PRECISION[self.precision])
         return '%s/write?db=%s' % (self.server_url, self.database)
 
     def get_request(self, url):
-        """Override and add username and password"""
+        """Override and add username and password, or the token"""
 
         # Get the basic Request from my superclass
         request = super(InfluxThread, self).get_request(url)
 
-        if self.username and self.password:
+        if self.api_version == 2:
+            if self.token:
+                request.add_header("Authorization", "Token %s" % self.token)
+        elif self.username and self.password:
             # Create a base64 byte string with the authorization info
             base64string = base64.b64encode(('%s:%s' % (self.username, self.password)).encode())
             # Add the authentication header to the request:
@@ -481,111 +1824,1030 @@ class InfluxThread(weewx.restx.RESTThread):
         return request
 
     def check_response(self, response):
+        self.metrics.count_status(response.code)
         if response.code == 204:
             return
         payload = response.read().decode()
         if payload and payload.find('results') >= 0:
             logdbg("code: %s payload: %s" % (response.code, payload))
             return
-        raise weewx.restx.FailedPost("Server returned '%s' (%s)" %
-                                     (payload, response.code))
+        # the server took the post but did not say it wrote anything.  it
+        # would do the same the next time.
+        raise DroppedPost("Server returned '%s' (%s)" %
+                          (payload, response.code))
 
     def handle_exception(self, e, count):
+        self.metrics.count('failed_attempts')
+        if isinstance(e, HTTPError):
+            self.metrics.count_status(e.code)
+        else:
+            self.metrics.count_error(e)
+        if isinstance(e, HTTPError) and e.code in THROTTLE_CODES:
+            # the server is too busy, so slow down.  if it says when to try
+            # again, the next try waits at least that long.
+            self.metrics.count('throttled')
+            retry_after = _get_retry_after(e)
+            self.throttle.slow_down(retry_after)
+            loginf("server is busy (%s), using %.0f%% of batch size%s" % (
+                e.code, 100 * self.throttle.share,
+                ', retry after %s seconds' % retry_after
+                if retry_after is not None else ''))
         if isinstance(e, HTTPError):
             payload = e.read().decode()
             logdbg("exception: %s payload: %s" % (e, payload))
             if payload and payload.find("error") >= 0:
                 if payload.find("database not found") >= 0:
-                    raise weewx.restx.AbortedPost(payload)
+                    raise DroppedPost(payload)
+            if e.code == 404 and payload.find("not found") >= 0:
+                # influx 2 reports an unknown bucket or org this way
+                raise DroppedPost(payload)
+            # the server will never accept lines that it could not parse or
+            # that conflict with what it has, so do not retry them, and do not
+            # leave them to block the spool.  the rest are posted again.
+            if e.code == 400:
+                raise RejectedPost(payload)
+            # bad credentials, a body that is too large, and the like are not
+            # the server being down, so do not hold everything else for them.
+            if 400 <= e.code < 500 and e.code not in RETRY_CLIENT_CODES:
+                raise DroppedPost("Server returned '%s' (%s)" %
+                                  (payload, e.code))
         super(InfluxThread, self).handle_exception(e, count)
 
     def post_request(self, request, payload=None):
-        # FIXME: provide full set of ssl options instead of this hack
-        if self.server_url.startswith('https'):
-            import ssl
-            encoded = None
-            if payload:
-                encoded = payload.encode('utf-8')
-            return urlopen(request, data=encoded, timeout=self.timeout,
-                           context=ssl._create_unverified_context())
-        return super(InfluxThread, self).post_request(request, payload)
-
-    def get_post_body(self, record):
+        if not self.keep_alive:
+            # FIXME: provide full set of ssl options instead of this hack
+            if self.server_url.startswith('https'):
+                import ssl
+                encoded = payload
+                if payload and not isinstance(payload, bytes):
+                    encoded = payload.encode('utf-8')
+                return urlopen(request, data=encoded, timeout=self.timeout,
+                               context=ssl._create_unverified_context())
+            return super(InfluxThread, self).post_request(request, payload)
+
+        # post using a persistent connection.  the response is read fully so
+        # that the connection can be used again.  error responses are raised
+        # as HTTPError, just as urlopen would do, so that check_response and
+        # handle_exception see the same things either way.
+        if payload is not None and not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        url = request.get_full_url()
+        parts = urlparse(url)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        headers = dict(request.header_items())
+        method = 'POST' if payload is not None else 'GET'
+        reused = self._conn is not None
+        conn = self.get_connection(parts)
+        try:
+            conn.request(method, path, body=payload, headers=headers)
+            response = conn.getresponse()
+        except (socket.error, http_client.HTTPException):
+            self.close_connection()
+            if not reused:
+                raise
+            # the server may have closed the connection while it was idle,
+            # so try once more with a fresh connection.
+            conn = self.get_connection(parts)
+            try:
+                conn.request(method, path, body=payload, headers=headers)
+                response = conn.getresponse()
+            except (socket.error, http_client.HTTPException):
+                self.close_connection()
+                raise
+        try:
+            body = response.read()
+        except (socket.error, http_client.HTTPException):
+            self.close_connection()
+            raise
+        self._conn_used = time.time()
+        if response.will_close:
+            self.close_connection()
+        if response.status >= 400:
+            raise HTTPError(url, response.status, response.reason,
+                            response.msg, io.BytesIO(body))
+        return addinfourl(io.BytesIO(body), response.msg, url, response.status)
+
+    def get_connection(self, parts):
+        """Return the persistent connection to the server, opening a new one
+        if there is none or if the existing one has been idle too long."""
+        key = (parts.scheme, parts.netloc)
+        if self._conn is not None and (
+                key != self._conn_key or
+                time.time() - self._conn_used > self.idle_timeout):
+            self.close_connection()
+        if self._conn is None:
+            if parts.scheme == 'https':
+                # FIXME: provide full set of ssl options instead of this hack
+                import ssl
+                self._conn = http_client.HTTPSConnection(
+                    parts.netloc, timeout=self.timeout,
+                    context=ssl._create_unverified_context())
+            else:
+                self._conn = http_client.HTTPConnection(
+                    parts.netloc, timeout=self.timeout)
+            self._conn_key = key
+            self._conn_used = time.time()
+        return self._conn
+
+    def close_connection(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except (socket.error, http_client.HTTPException):
+                pass
+            self._conn = None
+
+    def get_post_body(self, record, binding=None):
         """Override my superclass and get the body of the POST"""
 
         # create the list of tags
         tags = ''
-        binding = record.pop('binding', None)
         if binding is not None:
             tags = ',binding=%s' % binding
         if self.tags:
             tags = '%s,%s' % (tags, self.tags)
 
+        # templates depend on the unit system, so keep a set for each
+        us = record['usUnits']
+        templates = self.templates.get(us)
+        if templates is None:
+            templates = self.templates[us] = dict()
+
         # if uploading everything, we must check every time the list of
         # variables that should be uploaded since variables may come and
         # go in a record.  use the inputs to override any generic template
         # generation.
         if self.obs_to_upload == 'all' or self.obs_to_upload == 'most':
             for f in record:
-                if self.obs_to_upload == 'most' and f in OBS_TO_SKIP:
-                    continue
-                if f not in self.templates:
-                    self.templates[f] = _get_template(f,
-                                                      self.inputs.get(f, {}),
-                                                      self.append_units_label,
-                                                      record['usUnits'])
+                if f not in templates:
+                    if self.obs_to_upload == 'most' and f in OBS_TO_SKIP:
+                        continue
+                    templates[f] = self._get_template(f, us)
 
         # otherwise, create the list of upload variables once, based on the
         # user-specified list of inputs.
-        elif not self.templates:
+        elif not templates:
             for f in self.inputs:
-                self.templates[f] = _get_template(f, self.inputs[f],
-                                                  self.append_units_label,
-                                                  record['usUnits'])
+                templates[f] = self._get_template(f, us)
 
         # loop through the templates, populating them with data from the
         # record.
+        ts = record['dateTime'] * self.ts_scale
+        if self.line_format == 'multi-line' or self.line_format == 'multi-line-dotted':
+            fmt = '%%s%s value=%%s %d' % (tags.replace('%', '%%'), ts)
+        else:
+            fmt = '%s%s'
         data = []
-        for k in self.templates:
+        for enc in templates.values():
+            v = record.get(enc.obs)
             try:
-                v = float(record.get(k))
-                name = self.templates[k].get('name', k)
-                fmt = self.templates[k].get('format', '%s')
-                to_units = self.templates[k].get('units')
-                if to_units is not None:
-                    (from_unit, from_group) = weewx.units.getStandardUnitType(
-                        record['usUnits'], k)
-                    from_t = (v, from_unit, from_group)
-                    v = weewx.units.convert(from_t, to_units)[0]
-                s = fmt % v
-                if self.line_format == 'multi-line-dotted':
-                    # use multiple lines with a dotted-name identifier
-                    n = "%s.%s" % (self.measurement, name)
-                    data.append('%s%s value=%s %d' %
-                                (n, tags, s, record['dateTime']*1000000000))
-                elif self.line_format == 'multi-line':
-                    # use multiple lines
-                    data.append('%s%s value=%s %d' %
-                                (name, tags, s, record['dateTime']*1000000000))
-                else:
-                    # use a single line
-                    data.append('%s=%s' % (name, s))
+                x = enc.value(v)
+                if enc.deadband is not None and self.in_deadband(
+                        enc, binding, x, record['dateTime']):
+                    continue
+                data.append(fmt % (enc.prefix, enc.fmt % x))
             except (TypeError, ValueError) as e:
                 # FIXME: influx1 does not support NULL.  for influx2, ensure
                 # that any None values are retained as NULL.
-                logdbg("skipped value '%s': %s" % (record.get(k), e))
+                logdbg("skipped value '%s': %s" % (v, e))
+        if not data:
+            return '', 'application/x-www-form-urlencoded'
         if self.line_format == 'multi-line' or self.line_format == 'multi-line-dotted':
             str_data = '\n'.join(data)
         else:
-            str_data = '%s%s %s %d' % (self.measurement, tags, ','.join(data), record['dateTime']*1000000000)
+            str_data = '%s%s %s %d' % (self._measurement, tags, ','.join(data), ts)
         return str_data, 'application/x-www-form-urlencoded'
 
+    def forget_uploaded(self):
+        """Something that was encoded will never reach the server, so the
+        deadband no longer knows what the server has.  Forget the values that
+        were uploaded, so that the next value of each observation is sent."""
+        self.last_uploaded.clear()
+
+    def check_queue_drops(self):
+        """The queue of a destination holds records that are encoded
+        already, so if it dropped any, forget the values that were uploaded"""
+        if self.destination is None:
+            return
+        dropped = sum(getattr(self.queue, 'dropped', dict()).values())
+        if dropped != self.queue_dropped:
+            self.queue_dropped = dropped
+            self.forget_uploaded()
+
+    def in_deadband(self, enc, binding, x, ts):
+        """Return True if a value is close enough to the last value that was
+        uploaded for the same observation and binding that it can be left
+        out.  Otherwise remember it as the last value uploaded.  The value is
+        remembered when it is encoded, not when the server accepts it, so
+        anything that drops encoded records must call forget_uploaded."""
+        key = (binding, enc)
+        (threshold, relative, max_silence) = enc.deadband
+        last = self.last_uploaded.get(key)
+        if last is not None and 0 <= ts - last[1] < max_silence:
+            if relative:
+                threshold *= abs(last[0])
+            if abs(x - last[0]) <= threshold:
+                return True
+        self.last_uploaded[key] = (x, ts)
+        return False
+
+    def _get_template(self, obs, unit_system):
+        return _get_template(obs, self.inputs.get(obs, {}),
+                             self.append_units_label, unit_system,
+                             self.line_format, self.measurement,
+                             self.unit_system)
+
+class InfluxEncoderThread(InfluxThread):
+    """Encode each record once, then hand the line protocol to the queues of
+    the InfluxThreads that post to each destination.  Every destination has
+    its own thread, queue, batching, spool, and retries, so a destination
+    that is slow or down does not hold up the others."""
+
+    def __init__(self, queue, writer_queues, **kwargs):
+        kwargs['create_database'] = False
+        kwargs['spool_file'] = None
+        # the writers report on the uploads
+        kwargs['metrics'] = None
+        super(InfluxEncoderThread, self).__init__(queue, **kwargs)
+        self.writer_queues = writer_queues
+
+    def run_loop(self, dbmanager=None):
+        try:
+            while True:
+                _record = self.queue.get()
+                # A None record is our signal to exit
+                if _record is None:
+                    return
+                entry = self.encode_record(_record, dbmanager)
+                if entry is not None:
+                    for q in self.writer_queues:
+                        q.put(entry)
+        except Exception as e:
+            # Some unknown exception occurred.  This is probably a serious
+            # problem, so do what the superclass does and exit.
+            logerr("Unexpected exception of type %s" % type(e))
+            logerr("Thread terminating. Reason: %s" % e)
+        finally:
+            # the writers are done when there is nothing more to write
+            for q in self.writer_queues:
+                q.put(None)
+
+
+class AugmentCache(object):
+    """Provide the rain totals that RESTThread.get_record would query from
+    the database for every record: hourRain, rain24, and dayRain.
+
+    The rain from the archive records of the past 24 hours is loaded once, then
+    kept up to date from the archive records that pass through the uploader,
+    or by asking the database for newer archive records once the next one is
+    due, and at most once every AUGMENT_REFRESH seconds.  Only rows newer than
+    the newest row already loaded are asked for, since a loop packet can pass
+    an archive boundary before that archive record is saved.  Everything is
+    loaded again at the start of each day, or if records arrive out of order.
+    The day and 24-hour totals are kept as running sums; the hour total is
+    summed from the last hour of rows.
+
+    augment returns None if the cache cannot be used for a record, in which
+    case the caller should fall back to the queries."""
+
+    def __init__(self, refresh=AUGMENT_REFRESH):
+        self.refresh = refresh
+        self.rows = collections.deque()
+        self.sod = None
+        self.us = None
+        # dateTime of the newest row loaded
+        self.last_ts = None
+        self.checked_ts = None
+        self.sum24 = 0.0
+        self.n24 = 0
+        self.day_sum = 0.0
+        self.day_n = 0
+
+    def augment(self, record, dbmanager, binding=None):
+        ts = record['dateTime']
+        try:
+            sod = startOfDay(ts)
+            if sod != self.sod or self.last_ts is None or ts < self.last_ts:
+                self.load(dbmanager, ts, sod)
+            elif binding == 'archive' and 'rain' in record:
+                # the archive record has already been saved to the database,
+                # so it is the newest row.  no need to ask for it, unless it
+                # was loaded already.
+                if ts > self.last_ts:
+                    self.add(ts, record.get('rain'), record['usUnits'])
+                self.checked_ts = ts
+            elif (ts - self.checked_ts >= self.refresh and
+                  ts >= self.next_row_ts()):
+                self.load_newer(dbmanager, ts)
+        except weedb.OperationalError as e:
+            logdbg("cannot augment record: %s" % e)
+            self.sod = None
+            return dict(record)
+        if self.sod is None or (self.us is not None and
+                                self.us != record['usUnits']):
+            return None
+        self.prune(ts)
+
+        hour_sum = 0.0
+        hour_n = 0
+        for (row_ts, rain) in reversed(self.rows):
+            if row_ts <= ts - 3600:
+                break
+            if rain is not None and row_ts <= ts:
+                hour_sum += rain
+                hour_n += 1
+
+        data = dict(record)
+        if 'hourRain' not in data:
+            data['hourRain'] = hour_sum if hour_n else None
+        if 'rain24' not in data:
+            data['rain24'] = self.sum24 if self.n24 else None
+        if 'dayRain' not in data:
+            data['dayRain'] = self.day_sum if self.day_n else None
+        return data
+
+    def next_row_ts(self):
+        """When the next archive record is expected, based on the interval
+        between the last two rows"""
+        if len(self.rows) < 2:
+            return 0
+        return 2 * self.rows[-1][0] - self.rows[-2][0]
+
+    def load(self, dbmanager, ts, sod):
+        self.rows.clear()
+        self.sum24 = self.day_sum = 0.0
+        self.n24 = self.day_n = 0
+        self.us = None
+        self.sod = sod
+        self.last_ts = ts - 86400
+        self.checked_ts = ts
+        for row in dbmanager.genSql(
+                "SELECT dateTime, rain, usUnits FROM %s "
+                "WHERE dateTime>? AND dateTime<=? ORDER BY dateTime" %
+                dbmanager.table_name, (ts - 86400, ts)):
+            self.add(row[0], row[1], row[2])
+
+    def load_newer(self, dbmanager, ts):
+        for row in dbmanager.genSql(
+                "SELECT dateTime, rain, usUnits FROM %s "
+                "WHERE dateTime>? AND dateTime<=? ORDER BY dateTime" %
+                dbmanager.table_name, (self.last_ts, ts)):
+            self.add(row[0], row[1], row[2])
+        self.checked_ts = ts
+
+    def add(self, ts, rain, us):
+        if self.us is None:
+            self.us = us
+        elif us != self.us:
+            # mixed units in the database.  let the queries deal with it.
+            self.sod = None
+            return
+        self.rows.append((ts, rain))
+        self.last_ts = ts
+        if rain is not None:
+            self.sum24 += rain
+            self.n24 += 1
+            if ts >= self.sod:
+                self.day_sum += rain
+                self.day_n += 1
+
+    def prune(self, ts):
+        pruned = False
+        while self.rows and self.rows[0][0] <= ts - 86400:
+            (_, rain) = self.rows.popleft()
+            if rain is not None:
+                self.n24 -= 1
+                pruned = True
+        if pruned:
+            # add them up again instead of subtracting, so that rounding
+            # errors do not accumulate.
+            self.sum24 = math.fsum([r for (_, r) in self.rows
+                                    if r is not None])
+
+
+class Spool(object):
+    """Write-ahead spool of encoded records, kept in a sqlite database so that
+    records that have not yet been accepted by the server survive a restart.
+    Each row holds the dateTime of a record and its line protocol."""
+
+    def __init__(self, filename, max_records=MAX_SIZE):
+        self.filename = filename
+        self.max_records = max_records
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS spool ("
+                          "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                          "dateTime INTEGER NOT NULL, "
+                          "body TEXT NOT NULL)")
+        self.conn.commit()
+
+    def add(self, batch):
+        """Append a list of (dateTime, body) tuples, then discard the oldest
+        rows if the spool holds more than max_records.  Return the number of
+        rows that were discarded."""
+        if not batch:
+            return 0
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO spool (dateTime, body) VALUES (?, ?)", batch)
+            cursor = self.conn.execute(
+                "DELETE FROM spool WHERE id <= (SELECT id FROM spool "
+                "ORDER BY id DESC LIMIT 1 OFFSET ?)", (self.max_records,))
+        return cursor.rowcount
+
+    def get(self, max_bytes, after_id=0):
+        """Return the oldest rows as (id, dateTime, body) tuples, up to
+        max_bytes of body.  At least one row is returned if there is one.
+        Rows up to and including after_id are skipped."""
+        rows = []
+        nbytes = 0
+        cursor = self.conn.execute(
+            "SELECT id, dateTime, body FROM spool WHERE id > ? ORDER BY id",
+            (after_id,))
+        try:
+            for row in cursor:
+                if rows and nbytes + len(row[2]) + 1 > max_bytes:
+                    break
+                rows.append(row)
+                nbytes += len(row[2]) + 1
+        finally:
+            cursor.close()
+        return rows
+
+    def remove(self, ids):
+        with self.conn:
+            self.conn.executemany("DELETE FROM spool WHERE id = ?",
+                                  [(x,) for x in ids])
+
+    def rewrite(self, changed, removed):
+        """Replace the body of some rows, given as (body, id) tuples, and
+        remove others, all at once.  The rows keep their place."""
+        with self.conn:
+            self.conn.executemany("UPDATE spool SET body = ? WHERE id = ?",
+                                  changed)
+            self.conn.executemany("DELETE FROM spool WHERE id = ?",
+                                  [(x,) for x in removed])
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+class RejectedPost(weewx.restx.AbortedPost):
+    """The server rejected some or all of the lines in a post.  The message
+    is the payload of the response, which tells which lines."""
+
+
+class DroppedPost(weewx.restx.AbortedPost):
+    """The server refused a post for a reason that trying again will not fix,
+    such as bad credentials or an unknown database."""
+
+
+class DeadLetterFile(object):
+    """Lines that the server rejected, appended to a file as line protocol
+    with a comment that tells when and why, so that they can be fixed and
+    uploaded later, for example with the influx write command."""
+
+    # the uploaders for every destination can share the file
+    lock = threading.Lock()
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def write(self, lines, reason, destination=None):
+        header = '# %s %s%s' % (
+            time.strftime('%Y-%m-%dT%H:%M:%S'),
+            '%s: ' % destination if destination else '', reason)
+        with self.lock:
+            with open(self.filename, 'a') as f:
+                f.write('%s\n%s\n' % (header, '\n'.join(lines)))
+
+
+def _get_rejected(payload, lines):
+    """Return the indexes of the lines of a post that the server rejected,
+    according to the payload of its 400 response"""
+    try:
+        reply = json.loads(payload)
+    except ValueError:
+        reply = None
+    if not isinstance(reply, dict):
+        reply = dict(error=payload)
+    text = '\n'.join(['%s' % reply[x] for x in ['error', 'message']
+                      if reply.get(x)])
+    numbers = set([int(n) for n in REJECTED_LINE_NUMBER.findall(text)])
+    texts = set(REJECTED_LINE.findall(text))
+    for item in reply.get('data') or []:
+        if isinstance(item, dict):
+            if item.get('line_number'):
+                numbers.add(int(item['line_number']))
+            if item.get('original_line'):
+                texts.add(item['original_line'])
+    conflicts = [(_escape_measurement(m), _escape_key(k), t)
+                 for (k, m, t) in FIELD_CONFLICT.findall(text)]
+    rejected = set()
+    for (i, line) in enumerate(lines):
+        # influx numbers lines from 1
+        if i + 1 in numbers or line in texts:
+            rejected.add(i)
+        elif conflicts:
+            for (m, k, t) in conflicts:
+                if _get_field_type(line, m, k) == t:
+                    rejected.add(i)
+    return rejected
+
+
+def _get_field_type(line, measurement, key):
+    """Return the type of a field in a line of line protocol, as influx names
+    it, or None if the line is not for that measurement or has no such field.
+    The measurement and key are escaped as they are in the line."""
+    parts = _split_line(line, ' ')
+    if len(parts) < 2 or _split_line(parts[0], ',')[0] != measurement:
+        return None
+    for field in _split_line(parts[1], ','):
+        kv = _split_line(field, '=')
+        if kv[0] != key:
+            continue
+        v = '='.join(kv[1:])
+        if v.startswith('"'):
+            return 'string'
+        if v.endswith('i'):
+            return 'integer'
+        if v.endswith('u'):
+            return 'unsigned'
+        if v in ['t', 'T', 'true', 'True', 'TRUE',
+                 'f', 'F', 'false', 'False', 'FALSE']:
+            return 'boolean'
+        return 'float'
+    return None
+
+
+def _split_line(s, sep):
+    """Split part of a line of line protocol at each separator that is not
+    escaped and not in a quoted string"""
+    parts = []
+    start = 0
+    quoted = False
+    i = 0
+    while i < len(s):
+        c = s[i]
+        if c == '\\':
+            i += 1
+        elif c == '"':
+            quoted = not quoted
+        elif c == sep and not quoted:
+            parts.append(s[start:i])
+            start = i + 1
+        i += 1
+    parts.append(s[start:])
+    return parts
+
+
+class CircuitBreaker(object):
+    """Keep track of whether the server is down.  The breaker opens when a
+    post fails after all of its tries.  While it is open, nothing is posted
+    until it is time to try again, and then only a single try is made.  Each
+    time that fails, the wait doubles, up to MAX_RETRY_WAIT, with random
+    jitter so that many stations do not all come back at the same moment.
+    The breaker closes when the server answers."""
+
+    def __init__(self, base_wait, max_wait=MAX_RETRY_WAIT):
+        self.base_wait = max(1.0, float(base_wait))
+        self.max_wait = max_wait
+        self.failures = 0
+        self.next_try = 0
+        # for engines with several posts at once, a try is in progress
+        self.probing = False
+
+    @property
+    def is_open(self):
+        return self.failures > 0
+
+    def ready(self):
+        """Return True if it is ok to post now"""
+        if not self.is_open:
+            return True
+        return not self.probing and time.time() >= self.next_try
+
+    def tries(self):
+        """How many tries a post should make, or None for max_tries"""
+        return 1 if self.is_open else None
+
+    def wait_time(self):
+        """Seconds until the next try"""
+        return max(0.0, self.next_try - time.time())
+
+    def failure(self, min_wait=0):
+        """Note a failed post.  Wait at least min_wait seconds before the
+        next try.  Return True if that changes anything, which it does not for
+        posts that started before the server was known to be down."""
+        if self.is_open and time.time() < self.next_try:
+            return False
+        self.probing = False
+        self.failures += 1
+        wait = min(self.max_wait,
+                   self.base_wait * 2 ** min(self.failures - 1, 20))
+        self.next_try = time.time() + max(random.uniform(wait / 2, wait),
+                                          min_wait)
+        return True
+
+    def success(self):
+        """Note a post that got an answer.  Return True if the breaker was
+        open."""
+        was_open = self.is_open
+        self.failures = 0
+        self.probing = False
+        return was_open
+
+
+class Throttle(object):
+    """Slow down while the server says that it is too busy, with additive
+    increase and multiplicative decrease (AIMD) of both the size of batches
+    and the rate of posts.  Each time the server is too busy, the share of
+    the configured batch size and the rate are halved.  After each post that
+    succeeds, they grow back a step at a time.  If the server says when to
+    try again, nothing is posted before then."""
+
+    def __init__(self):
+        self.share = 1.0
+        # posts per second, or None for no limit
+        self.rate = None
+        # no post before this time
+        self.until = 0
+        # the time of the next post, when there is a limit on the rate
+        self.next_post = 0
+        self.lock = threading.Lock()
+
+    def slow_down(self, retry_after=None):
+        with self.lock:
+            self.share = max(THROTTLE_MIN_SHARE, self.share / 2)
+            self.rate = max(THROTTLE_MIN_RATE,
+                            (self.rate or THROTTLE_MAX_RATE) / 2)
+            if retry_after is not None:
+                self.until = max(self.until, time.time() +
+                                 min(retry_after, MAX_RETRY_WAIT))
+
+    def speed_up(self):
+        with self.lock:
+            self.share = min(1.0, self.share + THROTTLE_STEP)
+            if self.rate is not None:
+                self.rate += THROTTLE_RATE_STEP
+                if self.rate >= THROTTLE_MAX_RATE:
+                    self.rate = None
+
+    def wait_time(self):
+        """Seconds until the server said to try again"""
+        return max(0.0, self.until - time.time())
+
+    def reserve(self):
+        """Take the next turn to post, and return how many seconds to wait
+        for it"""
+        with self.lock:
+            now = time.time()
+            start = max(now, self.until)
+            if self.rate is not None:
+                start = max(start, self.next_post)
+                self.next_post = start + 1.0 / self.rate
+            return start - now
+
+
+def _get_retry_after(e):
+    """Return the seconds in the Retry-After header of an HTTPError, which
+    can be either a number of seconds or a date, or None if there is none"""
+    value = e.info().get('Retry-After') if e.info() is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = email.utils.parsedate_tz(value)
+    if parts is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(parts) - time.time())
+
+
+class Histogram(object):
+    """The values of a metric since the last report"""
+
+    def __init__(self):
+        self.values = []
+
+    def add(self, value):
+        self.values.append(value)
+
+    def report(self):
+        """Return a summary of the values, then start over"""
+        values = sorted(self.values)
+        self.values = []
+        n = len(values)
+        summary = {'count': n}
+        if n:
+            summary['mean'] = math.fsum(values) / n
+            summary['max'] = values[-1]
+            for p in METRICS_PERCENTILES:
+                summary['p%d' % p] = values[min(n - 1, n * p // 100)]
+        return summary
+
+
+class UploadMetrics(object):
+    """Counters and histograms that tell how an uploader is keeping up.
+    Counters are totals since the uploader started.  Histograms cover the
+    time since the last report."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.status = dict()
+        self.errors = dict()
+        self.histograms = dict()
+        self.last_ts = None
+        self.last_success = None
+        self.queue_depth_max = 0
+        # for the rate at which bytes are sent
+        self.report_time = time.time()
+        self.report_bytes = 0
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def count_status(self, code):
+        with self.lock:
+            self.status[code] = self.status.get(code, 0) + 1
+
+    def count_error(self, e):
+        name = e.__class__.__name__
+        with self.lock:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def add(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].add(value)
+
+    def add_post(self, batch, e, elapsed):
+        """Count the outcome of posting a batch"""
+        self.count('posts')
+        batch = [x for x in batch if not isinstance(x, MetricsPoint)]
+        if not batch:
+            pass
+        elif e is None:
+            self.count('records_published', len(batch))
+            self.last_ts = max(self.last_ts or 0, batch[-1][0])
+            self.last_success = time.time()
+        elif isinstance(e, weewx.restx.FailedPost):
+            self.count('records_failed', len(batch))
+        else:
+            self.count('records_rejected', len(batch))
+        if elapsed is not None:
+            self.add('post_latency', elapsed)
+
+    def report(self, q=None):
+        """Return the metrics as a flat dictionary"""
+        values = dict()
+        with self.lock:
+            values.update(self.counters)
+            for code in self.status:
+                values['status_%s' % code] = self.status[code]
+            for name in self.errors:
+                values['error_%s' % name] = self.errors[name]
+            for name in self.histograms:
+                summary = self.histograms[name].report()
+                for x in summary:
+                    values['%s_%s' % (name, x)] = summary[x]
+        if q is not None:
+            depth = q.qsize()
+            self.queue_depth_max = max(self.queue_depth_max, depth)
+            values['queue_depth'] = depth
+            values['queue_depth_max'] = self.queue_depth_max
+            # records that the queue had no room for
+            if isinstance(q, InfluxQueue):
+                values['records_dropped'] = (values.get('records_dropped', 0)
+                                             + sum(q.dropped.values()))
+                values['records_coalesced'] = q.coalesced
+        now = time.time()
+        if self.last_ts is not None:
+            values['lag'] = now - self.last_ts
+        if self.last_success is not None:
+            values['last_success_age'] = now - self.last_success
+        sent = values.get('bytes_sent', 0)
+        if now > self.report_time:
+            values['bytes_per_second'] = ((sent - self.report_bytes) /
+                                          (now - self.report_time))
+        self.report_time = now
+        self.report_bytes = sent
+        return values
+
+
+class LogMetricsSink(object):
+    """Report metrics as a line in the log"""
+
+    def emit(self, thread, values):
+        prefix = 'metrics'
+        if thread.destination:
+            prefix = 'metrics for %s' % thread.destination
+        loginf("%s: %s" % (prefix, ' '.join(
+            ['%s=%s' % (k, _format_metric(values[k]))
+             for k in sorted(values)])))
+
+
+class JsonMetricsSink(object):
+    """Report metrics to a JSON file, with an object for each destination.
+    The file is replaced each time, so a reader never sees half of it."""
+
+    # the uploaders for every destination share the file
+    lock = threading.Lock()
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def emit(self, thread, values):
+        with self.lock:
+            try:
+                with open(self.filename) as f:
+                    data = json.load(f)
+            except (IOError, OSError, ValueError):
+                data = dict()
+            data[thread.destination or 'default'] = dict(
+                values, timestamp=int(time.time()))
+            tmp = '%s.tmp' % self.filename
+            with open(tmp, 'w') as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+            os.rename(tmp, self.filename)
+
+
+class MetricsPoint(tuple):
+    """A (timestamp, line protocol) entry in a batch that holds metrics
+    rather than data"""
+    __slots__ = ()
+
+
+class InfluxMetricsSink(object):
+    """Report metrics as a point in the influx database, sent in the same
+    post as the next batch of data.  The point has the same tags as the data,
+    so that the uploaders of many stations can be told apart, plus the name of
+    the destination, if any."""
+
+    def __init__(self, measurement=None):
+        self.measurement = _escape_measurement(
+            measurement or METRICS_MEASUREMENT)
+
+    def emit(self, thread, values):
+        tags = ''
+        if thread.tags:
+            tags = ',%s' % thread.tags
+        if thread.destination:
+            tags = '%s,destination=%s' % (tags,
+                                          _escape_key(thread.destination))
+        fields = ','.join(['%s=%s' % (_escape_key(k), float(values[k]))
+                           for k in sorted(values)])
+        ts = int(time.time())
+        thread.metrics_points.append(MetricsPoint(
+            (ts, '%s%s %s %d' % (self.measurement, tags, fields,
+                                 ts * thread.ts_scale))))
+
+
+METRICS_SINKS = {
+    'log': LogMetricsSink,
+    'json': JsonMetricsSink,
+    'influx': InfluxMetricsSink,
+}
+
+# get the metrics sinks for a list of names
+def _get_metrics_sinks(names, filename=None, measurement=None):
+    if not names:
+        return []
+    if not isinstance(names, list):
+        names = names.split(',')
+    sinks = []
+    for name in names:
+        name = name.strip().lower()
+        if name in ['', 'none']:
+            continue
+        if name not in METRICS_SINKS:
+            raise weewx.ViolatedPrecondition(
+                "unknown metrics sink '%s'" % name)
+        if name == 'json':
+            if not filename:
+                raise weewx.ViolatedPrecondition(
+                    "json metrics require a metrics_file")
+            sinks.append(JsonMetricsSink(filename))
+        elif name == 'influx':
+            sinks.append(InfluxMetricsSink(measurement))
+        else:
+            sinks.append(METRICS_SINKS[name]())
+    return sinks
+
+# format a metric for the log
+def _format_metric(v):
+    if isinstance(v, float):
+        return '%.6g' % v
+    return str(v)
+
+
+def backfill(cfg_dict, start_ts=None, stop_ts=None, checkpoint=None,
+             batch_size=5000, compression='gzip'):
+    """Upload archive records from the weewx database, using the same
+    configuration as the Influx service.  Records are sent in large batches.
+    If a checkpoint file is specified, the dateTime of the last record that
+    was uploaded is saved there after each batch, and an interrupted run that
+    uses the same checkpoint file will resume from that point.  Returns the
+    number of records that were uploaded."""
+    site_dict = _get_site_dict(cfg_dict)
+    if site_dict is None:
+        raise weewx.ViolatedPrecondition("no Influx section with a database")
+    site_dict.pop('binding', None)
+    for x in SERVICE_OPTIONS:
+        site_dict.pop(x, None)
+    # records are posted to each destination, if there are any, otherwise
+    # to the server_url.  the checkpoint is saved once all have the batch.
+    dest_dicts = _get_destinations(cfg_dict, site_dict) or [site_dict]
+    writers = []
+    for dest_dict in dest_dicts:
+        dest_dict.pop('spool_file', None)
+        dest_dict['batch_size'] = batch_size
+        if compression is not None:
+            dest_dict['compression'] = compression
+        writers.append(InfluxThread(queue.Queue(), **dest_dict))
+    for w in writers:
+        if not w.provisioned:
+            w.provision(max_tries=1)
+    t = writers[0] if dest_dicts[0] is site_dict else InfluxThread(
+        queue.Queue(), **dict(site_dict, create_database=False))
+
+    if checkpoint:
+        try:
+            with open(checkpoint) as f:
+                last_ts = int(f.read().strip())
+            if start_ts is None or last_ts > start_ts:
+                start_ts = last_ts
+            loginf("resuming after %s" % timestamp_to_string(start_ts))
+        except (IOError, OSError, ValueError):
+            pass
+
+    count = 0
+    dbmanager = weewx.manager.open_manager_with_config(cfg_dict, 'wx_binding')
+    try:
+        batch = []
+        nbytes = 0
+        for record in dbmanager.genBatchRecords(start_ts, stop_ts):
+            body, _ = t.get_post_body(
+                t.get_record(record, dbmanager, 'archive'), 'archive')
+            if body:
+                batch.append((record['dateTime'], body))
+                nbytes += len(body) + 1
+            if len(batch) >= batch_size or nbytes >= t.batch_max_bytes:
+                count += _backfill_batch(writers, batch, checkpoint)
+                batch = []
+                nbytes = 0
+        if batch:
+            count += _backfill_batch(writers, batch, checkpoint)
+    finally:
+        dbmanager.close()
+        for w in writers:
+            w.close_connection()
+    return count
+
+def _backfill_batch(writers, batch, checkpoint):
+    for w in writers:
+        # each writer gets its own copy, since lines that a server rejects
+        # are taken out of the batch
+        if not w.send_batch(list(batch)):
+            raise weewx.restx.FailedPost("backfill stopped at %s" %
+                                         timestamp_to_string(batch[0][0]))
+    if checkpoint:
+        with open(checkpoint, 'w') as f:
+            f.write("%d\n" % batch[-1][0])
+    return len(batch)
+
+def _parse_time(s):
+    """Convert YYYY-MM-DD, YYYY-MM-DDTHH:MM, or epoch seconds to a unix
+    timestamp in local time"""
+    if s is None:
+        return None
+    if s.isdigit():
+        return int(s)
+    for fmt in ['%Y-%m-%dT%H:%M', '%Y-%m-%d']:
+        try:
+            return int(time.mktime(time.strptime(s, fmt)))
+        except ValueError:
+            pass
+    raise ValueError("cannot parse time '%s'" % s)
+
 # Use this hook to test the uploader:
 #   PYTHONPATH=bin python bin/user/influx.py
+#
+# or to upload the archive from an existing weewx database:
+#   PYTHONPATH=bin python bin/user/influx.py --backfill --config=weewx.conf
 
 if __name__ == "__main__":
     import optparse
-    import time
 
     weewx.debug = 2
 
@@ -595,7 +2857,11 @@ if __name__ == "__main__":
                         [--user=USER] [--password=PASSWORD]
                         [--admin-user=ADMIN-USER] [--admin-password=ADMIN-PASSWORD]
                         [--database=DBNAME] [--measurement=MEASUREMENT]
-                        [--tags=TAGS]"""
+                        [--tags=TAGS]
+       python -m influx --backfill --config=CONFIG_FILE
+                        [--start=START] [--stop=STOP]
+                        [--checkpoint=CHECKPOINT_FILE]
+                        [--batch-size=N]"""
 
     parser = optparse.OptionParser(usage=usage)
     parser.add_option('--version', action='store_true',
@@ -624,16 +2890,48 @@ if __name__ == "__main__":
     parser.add_option('--tags', default='station=A,field=C',
                       help="Influxdb tags to be used. Default is 'station=A,field=C'",
                       metavar="TAGS")
+    parser.add_option('--backfill', action='store_true',
+                      help="Upload archive records from the weewx database, "
+                      "using the Influx section of the weewx configuration")
+    parser.add_option('--config',
+                      help="Path to the weewx configuration file",
+                      metavar="CONFIG_FILE")
+    parser.add_option('--start',
+                      help="Upload records after this time, as YYYY-MM-DD, "
+                      "YYYY-MM-DDTHH:MM, or epoch seconds",
+                      metavar="START")
+    parser.add_option('--stop',
+                      help="Upload records up to and including this time",
+                      metavar="STOP")
+    parser.add_option('--checkpoint',
+                      help="File in which to save progress, so that an "
+                      "interrupted backfill can be resumed",
+                      metavar="CHECKPOINT_FILE")
+    parser.add_option('--batch-size', type='int', default=5000,
+                      help="Number of records per POST. Default is 5000",
+                      metavar="N")
     (options, args) = parser.parse_args()
 
     if options.version:
         print("weewx-influxdb version %s" % VERSION)
         exit(0)
 
+    if options.backfill:
+        import weecfg
+        config_path, config_dict = weecfg.read_config(options.config, args)
+        print("Using configuration file %s" % config_path)
+        n = backfill(config_dict,
+                     start_ts=_parse_time(options.start),
+                     stop_ts=_parse_time(options.stop),
+                     checkpoint=options.checkpoint,
+                     batch_size=options.batch_size)
+        print("Uploaded %d records" % n)
+        exit(0)
+
     print("Using server-url of '%s'" % options.server_url)
 
-    queue = queue.Queue()
-    t = InfluxThread(queue,
+    q = queue.Queue()
+    t = InfluxThread(q,
                      manager_dict=None,
                      database=options.database,
                      username=options.user,
@@ -641,10 +2939,10 @@ if __name__ == "__main__":
                      measurement=options.measurement,
                      tags=options.tags,
                      server_url=options.server_url)
-    queue.put({'dateTime': int(time.time() + 0.5),
-               'usUnits': weewx.US,
-               'outTemp': 32.5,
-               'inTemp': 75.8,
-               'outHumidity': 24})
-    queue.put(None)
+    q.put({'dateTime': int(time.time() + 0.5),
+           'usUnits': weewx.US,
+           'outTemp': 32.5,
+           'inTemp': 75.8,
+           'outHumidity': 24})
+    q.put(None)
     t.run()
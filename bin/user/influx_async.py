@@ -0,0 +1,392 @@
+# Copyright 2016-2021 Matthew Wall
+# Distributed under the terms of the GNU Public License (GPLv3)
+
+"""
+Asyncio upload engine for the Influx uploader.
+
+The thread engine in influx.py posts one batch at a time, so a single slow
+response from the server holds up every record behind it.  This engine runs
+an event loop in the uploader thread instead.  Records are still taken from
+the queue and encoded by the InfluxThread, but each batch is posted as an
+asyncio task over a pool of kept-alive connections, with up to max_in_flight
+posts in progress at once.  Each post has its own timeout, and responses go
+through the same check_response and handle_exception as the thread engine.
+When the server is down, batches are held until the circuit breaker of the
+InfluxThread says that it is time to try again, just as the thread engine
+does, and a single post at a time finds out whether the server is back.
+
+This module requires python 3, so it is loaded only when engine=asyncio.
+"""
+
+import asyncio
+import http.client
+import io
+import queue
+import socket
+import ssl
+import sys
+import time
+from urllib.error import HTTPError
+from urllib.parse import urlparse
+from urllib.response import addinfourl
+
+import weewx.restx
+
+from user.influx import RejectedPost, logerr
+
+
+class ConnectionPool(object):
+    """Kept-alive HTTP/1.1 connections to a single server"""
+
+    def __init__(self, server_url, idle_timeout=30):
+        parts = urlparse(server_url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.netloc = parts.netloc
+        self.ssl = None
+        if parts.scheme == 'https':
+            # FIXME: provide full set of ssl options instead of this hack
+            self.ssl = ssl._create_unverified_context()
+        self.idle_timeout = idle_timeout
+        self.idle = []
+
+    async def request(self, method, url, headers, body):
+        """Send a request and return the response as a file-like object with
+        a code, just like urlopen.  Error responses are raised as HTTPError.
+        A connection that was idle may have been closed by the server, so
+        if it fails before there is any response, try a new connection."""
+        while True:
+            conn = self._get_idle()
+            reused = conn is not None
+            if conn is None:
+                conn = await asyncio.open_connection(self.host, self.port,
+                                                     ssl=self.ssl)
+            try:
+                code, reason, msg, data, keep = await self._exchange(
+                    conn, method, url, headers, body)
+                break
+            except (ConnectionError, asyncio.IncompleteReadError,
+                    http.client.RemoteDisconnected):
+                self._close(conn)
+                if not reused:
+                    raise
+            except BaseException:
+                self._close(conn)
+                raise
+        if keep:
+            self.idle.append((conn, time.time()))
+        else:
+            self._close(conn)
+        if code >= 400:
+            raise HTTPError(url, code, reason, msg, io.BytesIO(data))
+        return addinfourl(io.BytesIO(data), msg, url, code)
+
+    async def _exchange(self, conn, method, url, headers, body):
+        (reader, writer) = conn
+        parts = urlparse(url)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        if body is not None and not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % self.netloc]
+        for (k, v) in headers:
+            if isinstance(v, bytes):
+                v = v.decode('latin-1')
+            lines.append('%s: %s' % (k, v))
+        lines.append('Content-Length: %d' % len(body or b''))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if body:
+            writer.write(body)
+        await writer.drain()
+
+        status = await reader.readline()
+        if not status:
+            raise http.client.RemoteDisconnected("no response from server")
+        parts = status.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        code = int(parts[1])
+        reason = parts[2] if len(parts) > 2 else ''
+        head = b''
+        while True:
+            line = await reader.readline()
+            head += line
+            if line in (b'\r\n', b'\n', b''):
+                break
+        msg = http.client.parse_headers(io.BytesIO(head))
+        data = b''
+        if msg.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readuntil(b'\r\n')
+                    break
+                data += await reader.readexactly(size)
+                await reader.readexactly(2)
+        elif msg.get('Content-Length') is not None:
+            data = await reader.readexactly(int(msg['Content-Length']))
+        elif code not in (204, 304):
+            # no length, so the body is whatever comes before the server
+            # closes the connection
+            data = await reader.read()
+            return code, reason, msg, data, False
+        keep = msg.get('Connection', '').lower() != 'close'
+        return code, reason, msg, data, keep
+
+    def _get_idle(self):
+        now = time.time()
+        while self.idle:
+            (conn, used) = self.idle.pop()
+            if now - used <= self.idle_timeout:
+                return conn
+            self._close(conn)
+        return None
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn[1].close()
+        except (socket.error, RuntimeError):
+            pass
+
+    def close(self):
+        while self.idle:
+            self._close(self.idle.pop()[0])
+
+
+class AsyncEngine(object):
+    """Take records from the queue of an InfluxThread, encode them with the
+    thread, and post the batches concurrently."""
+
+    # how long to wait for the queue at a time, so that the executor thread
+    # that waits on the queue is never stuck for long
+    QUEUE_POLL = 1.0
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.pool = ConnectionPool(thread.server_url, thread.idle_timeout)
+        self.loop = None
+        self.slots = None
+        self.tasks = set()
+        self.error = None
+        # spool rows up to this id have been handed to a post
+        self.spool_mark = 0
+
+    def run(self, dbmanager=None):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.main(dbmanager))
+        finally:
+            self.pool.close()
+            # give the transports a chance to close their sockets
+            self.loop.run_until_complete(asyncio.sleep(0))
+            self.loop.close()
+
+    async def main(self, dbmanager):
+        t = self.thread
+        self.slots = asyncio.Semaphore(t.max_in_flight)
+        try:
+            if t.spool is not None:
+                await self.flush_spool()
+            while self.error is None:
+                if (t.spool is None and t.held and
+                        not await self.wait_for_breaker()):
+                    # leave new records in the queue, where queue_size and
+                    # overflow_policy limit them
+                    await self.flush_held()
+                    continue
+                batch = []
+                done = await self.get_batch(batch, dbmanager)
+                t.take_metrics_points(batch)
+                if t.spool is not None:
+                    if t.spool.add(batch):
+                        t.forget_uploaded()
+                    await self.flush_spool()
+                else:
+                    t.hold(batch)
+                    await self.flush_held()
+                if done:
+                    break
+            if self.tasks:
+                await asyncio.wait(self.tasks)
+        except Exception as e:
+            self.error = e
+        if self.error is not None:
+            # Some unknown exception occurred.  This is probably a serious
+            # problem, so do what the thread engine does and exit.
+            logerr("Unexpected exception of type %s" % type(self.error))
+            logerr("Thread terminating. Reason: %s" % self.error)
+
+    async def wait_for_breaker(self):
+        """Wait until the circuit breaker says it is ok to post, reporting
+        the metrics when they are due.  Return True if the queue has been told
+        to shut down meanwhile."""
+        t = self.thread
+        while not t.breaker.ready():
+            if self.error is not None or t.wait_for_shutdown(0):
+                return True
+            t.report_metrics()
+            await asyncio.sleep(min(self.QUEUE_POLL,
+                                    max(0.1, t.breaker.wait_time())))
+        return False
+
+    async def get_batch(self, batch, dbmanager):
+        """Same as InfluxThread.get_batch, but wait for the queue without
+        blocking the event loop"""
+        t = self.thread
+        (batch_size, max_bytes) = t.batch_limits()
+        t.check_queue_drops()
+        nbytes = 0
+        deadline = None
+        if t.catch_up and not t.queue.empty():
+            batch_size = sys.maxsize
+            deadline = time.time()
+        else:
+            t.catch_up = False
+        while len(batch) < batch_size and nbytes < max_bytes:
+            if self.error is not None:
+                return True
+            if deadline is None and t.backlog and t.breaker.ready():
+                # time to try the server again
+                break
+            try:
+                _record = t.queue.get_nowait()
+            except queue.Empty:
+                if deadline is None:
+                    # nothing to do but report the metrics when they are due
+                    t.report_metrics()
+                    wait = self.QUEUE_POLL
+                else:
+                    wait = min(self.QUEUE_POLL, deadline - time.time())
+                    if wait <= 0:
+                        break
+                try:
+                    _record = await self.loop.run_in_executor(
+                        None, t.queue.get, True, wait)
+                except queue.Empty:
+                    continue
+            # A None record is our signal to exit
+            if _record is None:
+                return True
+            # encoding happens here in the uploader thread, which is the one
+            # that owns the database connection
+            entry = t.encode_record(_record, dbmanager)
+            if entry is None:
+                continue
+            batch.append(entry)
+            nbytes += len(entry[1]) + 1
+            if deadline is None:
+                deadline = time.time() + t.batch_linger
+        return False
+
+    async def flush_spool(self):
+        """Hand everything in the spool that is not already being posted to
+        new posts.  Rows stay in the spool until their post succeeds.  If a
+        post fails, everything after the failed rows will be posted again
+        from the oldest row, once the posts in progress have finished."""
+        t = self.thread
+        while self.error is None and t.breaker.ready():
+            rows = t.spool.get(t.batch_limits()[1], self.spool_mark)
+            if not rows:
+                t.backlog = False
+                return
+            self.spool_mark = rows[-1][0]
+            await self.dispatch([(ts, body) for (_, ts, body) in rows],
+                                [r[0] for r in rows])
+
+    async def flush_held(self):
+        """Hand the records held by the thread to new posts.  A post that
+        fails puts its records back at the front."""
+        t = self.thread
+        while self.error is None and t.held and t.breaker.ready():
+            await self.dispatch(t.take_held())
+        if not t.held:
+            t.backlog = False
+
+    async def dispatch(self, batch, ids=None):
+        """Start a post for the batch as soon as there is a free slot.  If
+        the server is down, this is the one post that finds out whether it is
+        back, so the others wait until it is done."""
+        await self.slots.acquire()
+        t = self.thread
+        if not t.breaker.ready():
+            # the server went down while waiting for the slot
+            self.slots.release()
+            self.put_back(batch, ids)
+            return
+        tries = t.breaker.tries()
+        if tries:
+            t.breaker.probing = True
+        task = asyncio.ensure_future(self.send_batch(batch, ids, tries))
+        self.tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self.tasks.discard(task)
+        self.slots.release()
+        if not task.cancelled() and task.exception() is not None:
+            self.error = task.exception()
+
+    async def send_batch(self, batch, ids=None, tries=None):
+        """Post a batch.  If the server rejects some of the lines, post the
+        rest again right away."""
+        t = self.thread
+        ok = True
+        while batch:
+            start = time.time()
+            try:
+                request, data = t.get_batch_request(batch)
+                if t.skip_upload:
+                    raise weewx.restx.AbortedPost("Skip post")
+                await self.post_with_retries(request, data, tries)
+            except RejectedPost as e:
+                batch = t.reject_lines(batch, e, time.time() - start, ids)
+                continue
+            except (weewx.restx.AbortedPost, weewx.restx.FailedPost) as e:
+                ok = t.report_batch(batch, e, time.time() - start)
+            else:
+                ok = t.report_batch(batch, None, time.time() - start)
+            break
+        if ok:
+            if ids is not None:
+                t.spool.remove(ids)
+        else:
+            self.put_back(batch, ids)
+
+    def put_back(self, batch, ids=None):
+        """Keep a batch that was not posted, to be posted again later"""
+        if ids is None:
+            self.thread.hold(batch, first=True)
+        else:
+            # start again from the oldest row on the next flush
+            self.spool_mark = 0
+
+    async def post_with_retries(self, request, data=None, tries=None):
+        """Same as InfluxThread.post_with_retries, but each attempt has its
+        own timeout, and waiting between attempts, or for the throttle, does
+        not block other posts."""
+        t = self.thread
+        url = request.get_full_url()
+        headers = request.header_items()
+        tries = tries or t.max_tries
+        for count in range(tries):
+            wait = t.throttle.reserve()
+            if count:
+                wait = max(wait, t.retry_wait)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                try:
+                    response = await asyncio.wait_for(
+                        self.pool.request('POST', url, headers, data),
+                        t.timeout)
+                except asyncio.TimeoutError:
+                    raise socket.timeout("timed out after %s seconds" %
+                                         t.timeout)
+                if 200 <= response.code <= 299:
+                    t.check_response(response)
+                    return
+                t.handle_code(response.code, count + 1)
+            except (HTTPError, socket.error, http.client.HTTPException,
+                    asyncio.IncompleteReadError) as e:
+                t.handle_exception(e, count + 1)
+        raise weewx.restx.FailedPost("Failed upload after %d tries" % tries)
@@ -10,7 +10,7 @@ def loader():
 class InfluxInstaller(ExtensionInstaller):
     def __init__(self):
         super(InfluxInstaller, self).__init__(
-            version="0.17",
+            version="0.18",
             name='influx',
             description='Upload weather data to Influx.',
             author="Matthew Wall",
@@ -21,5 +21,6 @@ class InfluxInstaller(ExtensionInstaller):
                     'Influx': {
                         'database': 'INSERT_DATABASE_HERE',
                         'host': 'INSERT_HOST_HERE'}}},
-            files=[('bin/user', ['bin/user/influx.py'])]
+            files=[('bin/user', ['bin/user/influx.py',
+                                 'bin/user/influx_async.py'])]
             )